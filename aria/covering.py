@@ -0,0 +1,136 @@
+# coding: utf-8
+"""Covering arrays
+"""
+from itertools import combinations, product
+
+
+__all__ = ['covering_array']
+
+
+def covering_array(sizes, strength=2, valid=None):
+    """Return rows of indices covering every ``strength``-way combination
+
+    ``sizes`` is the number of values of each column. Rows are built with
+    the IPOG strategy: the first ``strength`` columns are fully combined,
+    then every other column is added one at a time, first by choosing the
+    best value for the existing rows (horizontal growth) and then by adding
+    rows for the combinations still uncovered (vertical growth).
+
+    ``valid(row)`` tells if a row, with ``None`` for the columns not set
+    yet, may still be valid: combinations and rows it rejects are left out.
+    The combinations of the rows that can't be completed are covered again
+    by new rows.
+    """
+    sizes = list(sizes)
+    if not sizes or min(sizes) <= 0:
+        return []
+    strength = max(1, min(strength, len(sizes)))
+    # bigger columns first: it keeps the array smaller
+    order = sorted(range(len(sizes)), key=lambda col: -sizes[col])
+    ordered = [sizes[col] for col in order]
+
+    def ok(row):
+        if valid is None:
+            return True
+        original = [None] * len(sizes)
+        for position, value in enumerate(row):
+            original[order[position]] = value
+        return valid(original)
+
+    def ok_tuple(group, values):
+        row = [None] * (max(group) + 1)
+        for c, v in zip(group, values):
+            row[c] = v
+        return ok(row)
+
+    rows = [list(row) for row in
+            product(*(range(size) for size in ordered[:strength]))
+            if ok(row)]
+    for col in range(strength, len(ordered)):
+        groups = list(combinations(range(col), strength - 1))
+        uncovered = set()
+        for group in groups:
+            for values in product(*(range(ordered[c]) for c in group)):
+                for value in range(ordered[col]):
+                    if ok_tuple(group + (col,), values + (value,)):
+                        uncovered.add((group, values + (value,)))
+
+        for row in rows:
+            best_value, best_covered = None, None
+            for value in range(ordered[col]):
+                if not ok(row + [value]):
+                    continue
+                covered = set()
+                for group in groups:
+                    values = tuple(row[c] for c in group)
+                    if None in values:
+                        continue
+                    key = (group, values + (value,))
+                    if key in uncovered:
+                        covered.add(key)
+                if best_covered is None or len(covered) > len(best_covered):
+                    best_value, best_covered = value, covered
+            row.append(best_value)
+            uncovered -= best_covered or set()
+
+        for group, values in sorted(uncovered):
+            for row in rows:
+                if row[col] not in (None, values[-1]):
+                    continue
+                if all(row[c] in (None, v) for c, v in zip(group, values)):
+                    merged = list(row)
+                    for c, v in zip(group + (col,), values):
+                        merged[c] = v
+                    if not ok(merged):
+                        continue
+                    row[:] = merged
+                    break
+            else:
+                row = [None] * (col + 1)
+                for c, v in zip(group + (col,), values):
+                    row[c] = v
+                rows.append(row)
+
+    done = [row for row in rows if fill(row, ordered, ok)]
+    if valid is not None and len(done) < len(rows):
+        covered = {(group, tuple(row[c] for c in group))
+                   for row in done
+                   for group in combinations(range(len(ordered)), strength)}
+        for group in combinations(range(len(ordered)), strength):
+            for values in product(*(range(ordered[c]) for c in group)):
+                if (group, values) in covered or not ok_tuple(group, values):
+                    continue
+                row = [None] * len(ordered)
+                for c, v in zip(group, values):
+                    row[c] = v
+                if fill(row, ordered, ok):
+                    done.append(row)
+                    covered.update((g, tuple(row[c] for c in g)) for g in
+                                   combinations(range(len(ordered)), strength))
+
+    result = []
+    for row in done:
+        original = [0] * len(sizes)
+        for position, col in enumerate(order):
+            original[col] = row[position]
+        result.append(tuple(original))
+    return result
+
+
+def fill(row, sizes, ok):
+    """Set the columns of ``row`` left to ``None``, return ``False`` (and
+    leave ``row`` as it was) if it can't be completed to a valid row
+    """
+    free = [col for col, value in enumerate(row) if value is None]
+
+    def search(position):
+        if position == len(free):
+            return True
+        col = free[position]
+        for value in range(sizes[col]):
+            row[col] = value
+            if ok(row) and search(position + 1):
+                return True
+        row[col] = None
+        return False
+    return search(0)
@@ -0,0 +1,178 @@
+# coding: utf-8
+"""Events of a walk and where they go
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+__all__ = ['Event', 'EventSink', 'NullSink', 'LoggingSink', 'RingBufferSink',
+           'QueueSink']
+
+
+class Event(object):
+    """Something that happened during a walk
+
+    kind: route_start, replay_start, step_enter, step_result, step_error,
+          route_stop, route_end, walk_pause, walk_end, route_replayed, log
+    ``step`` is the step entered, or the step (or outcome) a case led to
+    for ``step_result``. ``message`` is only formatted when a sink asks
+    for it, ``None`` for events that were never logged.
+    """
+    __slots__ = ('kind', 'step', 'label', 'data', 'time')
+
+    def __init__(self, kind, step=None, label=None, **data):
+        self.kind = kind
+        self.step = step
+        self.label = label
+        self.data = data
+        self.time = time.time()
+
+    @property
+    def message(self):
+        formatter = FORMATS.get(self.kind)
+        return formatter(self) if formatter else None
+
+    def __repr__(self):
+        return '<{} {} {!r}>'.format(self.__class__.__name__, self.kind,
+                                     self.message)
+
+
+def _banner(text):
+    return ' {} '.format(text).center(40, '=')
+
+
+def _step_label(event):
+    msg = str(event.step)
+    if event.label:
+        msg += ' ({})'.format(event.label)
+    return msg
+
+
+def _replayed(event):
+    result = event.data['result']
+    if result.passed:
+        return 'route {}: passed'.format(result.route_id)
+    actual = result.actual[result.depth:result.depth + 1] or ['nothing']
+    expected = result.expected[result.depth:result.depth + 1] or ['the end']
+    return 'route {}: {} instead of {} at case {}'.format(
+        result.route_id, actual[0], expected[0], result.depth + 1)
+
+
+FORMATS = {
+    'route_start': lambda event: _banner(event.data['route']),
+    'replay_start': lambda event: _banner(event.data['route']),
+    'step_enter': _step_label,
+    'step_result': lambda event: (str(event.step)
+                                  if isinstance(event.step, Exception) else None),
+    'step_error': lambda event: 'Something goes wrong with {}({})'.format(
+        event.step, event.label),
+    'route_stop': _step_label,
+    'walk_pause': lambda event: _banner(event.label),
+    'walk_end': lambda event: _banner('THE END'),
+    'log': _step_label,
+    'route_replayed': _replayed,
+}
+
+
+class EventSink(object):
+    """Base
+    """
+    enabled = True
+
+    def emit(self, event):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class NullSink(EventSink):
+    """Drop every event, without even building them
+    """
+    enabled = False
+
+    def emit(self, event):
+        pass
+
+
+class LoggingSink(EventSink):
+    """Log the message of every event, the way walks always did
+
+    Without ``logger``, events go to ``aria.walker``; if logging is not
+    configured, it is given a handler printing to stderr at ``INFO``.
+    """
+    def __init__(self, logger=None):
+        if logger is None:
+            logger = logging.getLogger('aria.walker')
+            if not logger.hasHandlers():
+                logger.addHandler(logging.StreamHandler())
+                if logger.level == logging.NOTSET:
+                    logger.setLevel(logging.INFO)
+        self.logger = logger
+
+    def emit(self, event):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        message = event.message
+        if message is None:
+            return
+        if event.kind == 'step_error':
+            self.logger.error(message, exc_info=event.data.get('exc_info'))
+        else:
+            self.logger.info(message)
+
+
+class RingBufferSink(EventSink):
+    """Keep the last ``size`` events in ``events``
+    """
+    def __init__(self, size=1000):
+        self.events = deque(maxlen=size)
+
+    def emit(self, event):
+        self.events.append(event)
+
+
+class QueueSink(EventSink):
+    """Hand events to ``sink`` from a background thread
+
+    The walker only pays for putting the event in a queue.
+    """
+    def __init__(self, sink=None, maxsize=0):
+        self.sink = sink or LoggingSink()
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self._forward)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, event):
+        self.queue.put(event)
+
+    def _forward(self):
+        while True:
+            event = self.queue.get()
+            try:
+                if event is None:
+                    return
+                self.sink.emit(event)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        self.queue.join()
+        self.sink.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.sink.close()
@@ -15,13 +15,69 @@ Case = namedtuple('Case', ('priority', 'label', 'value'))
 
 class BaseField(object):
     """Base
+
+    Random values are drawn from the global ``random`` module, or, once the
+    field is given a ``seed``, from streams derived from it: the same seed
+    always gives the same sequence of values.
+
+    The cases of each priority are built once and cached until ``refresh``
+    (or a new seed).
     """
+    seed = None
+    _tables = None
+    _streams = None
+
+    def reseed(self, seed):
+        if seed != self.seed:
+            self.seed = seed
+            self._streams = {}
+            self.refresh()
+
+    def refresh(self):
+        """Drop the cached cases, random values are drawn again
+        """
+        self._tables = None
+
+    def cases(self, priority):
+        """Return the cases of ``priority`` (``p0``, ``p1`` or ``p2``)
+        """
+        tables = self._tables
+        if tables is None:
+            tables = self._tables = {}
+        table = tables.get(priority)
+        if table is None:
+            provider = getattr(self, priority + '_cases', lambda: ())
+            table = tables[priority] = tuple(
+                Case(priority, label, value) for label, value in provider())
+        return table
+
+    def rng(self, tag):
+        """Return the random stream of ``tag`` (``p0``, ``generate``...)
+        """
+        if self.seed is None:
+            return random
+        if self._streams is None:
+            self._streams = {}
+        stream = self._streams.get(tag)
+        if stream is None:
+            stream = self._streams[tag] = random.Random(
+                '{}/{}'.format(self.seed, tag))
+        return stream
+
+    def generate(self, n):
+        """Return ``n`` random p0 values
+        """
+        raise NotImplementedError()
+
     def iter_cases(self, include):
         include = include or ['p0', 'p1']
         for priority in include:
-            provider = getattr(self, priority + '_cases', lambda: iter(''))
-            for label, value in provider():
-                yield Case(priority, label, value)
+            for case in self.cases(priority):
+                yield case
+
+    def count_cases(self, include):
+        include = include or ['p0', 'p1']
+        return sum(len(self.cases(priority)) for priority in include)
 
     def p0_cases(self):
         raise NotImplementedError()
@@ -49,6 +105,10 @@ class EnumField(BaseField):
             warnings.warn("A single-value EnumField is not very useful: "
                           "{!r}".format(self.values + self.bad_values))
 
+    def generate(self, n):
+        values = [value for _, value in self.values]
+        return self.rng('generate').choices(values, k=n)
+
     def p0_cases(self):
         return self.values[:1]
 
@@ -66,9 +126,14 @@ class IntegerField(BaseField):
         self.min_value = min_value
         self.max_value = max_value
 
+    def generate(self, n):
+        return self.rng('generate').choices(
+            range(self.min_value + 1, self.max_value), k=n)
+
     def p0_cases(self):
         return [
-            ('normal', random.randint(self.min_value + 1, self.max_value - 1)),
+            ('normal', self.rng('p0').randint(self.min_value + 1,
+                                              self.max_value - 1)),
         ]
 
     def p1_cases(self):
@@ -94,30 +159,54 @@ class TextField(BaseField):
         self.max_length = max_length or min_length
         self.chars = chars or ALPHANUM
 
+    def generate(self, n):
+        return random_texts(n, self.min_length, self.max_length, self.chars,
+                            self.rng('generate'))
+
     def p0_cases(self):
+        rng = self.rng('p0')
         return [
-            ('plain', random_text(self.min_length, self.max_length, self.chars)),
+            ('plain', random_text(self.min_length, self.max_length, self.chars, rng)),
         ]
 
     def p1_cases(self):
+        rng = self.rng('p1')
         return [
             ('empty', ''),
-            ('min', random_text(self.min_length, chars=self.chars)),
-            ('max', random_text(self.max_length, chars=self.chars)),
+            ('min', random_text(self.min_length, chars=self.chars, rng=rng)),
+            ('max', random_text(self.max_length, chars=self.chars, rng=rng)),
         ]
 
     def p2_cases(self):
+        rng = self.rng('p2')
         return [
-            ('<min', random_text(self.min_length - 1, chars=self.chars)),
-            ('>max', random_text(self.max_length + 1, chars=self.chars)),
-            ('danger', random_text(self.min_length, self.max_length, chars='"&?%#@*')),
+            ('<min', random_text(self.min_length - 1, chars=self.chars, rng=rng)),
+            ('>max', random_text(self.max_length + 1, chars=self.chars, rng=rng)),
+            ('danger', random_text(self.min_length, self.max_length, chars='"&?%#@*',
+                                   rng=rng)),
         ]
 
 
-def random_text(min_length, max_length=None, chars=None):
+def random_text(min_length, max_length=None, chars=None, rng=None):
     min_length = max(min_length, 1)
     max_length = max_length or min_length
     chars = chars or ALPHANUM
-    length = random.randint(min_length, max_length)
-    text = ''.join(random.choice(chars) for _ in range(length))
-    return text
+    rng = rng or random
+    length = rng.randint(min_length, max_length)
+    return ''.join(rng.choices(chars, k=length))
+
+
+def random_texts(n, min_length, max_length=None, chars=None, rng=None):
+    """Return ``n`` random texts, drawn in one pass
+    """
+    min_length = max(min_length, 1)
+    max_length = max(max_length or min_length, min_length)
+    chars = chars or ALPHANUM
+    rng = rng or random
+    lengths = rng.choices(range(min_length, max_length + 1), k=n)
+    pool = ''.join(rng.choices(chars, k=sum(lengths)))
+    texts, pos = [], 0
+    for length in lengths:
+        texts.append(pool[pos:pos + length])
+        pos += length
+    return texts
@@ -1,32 +1,52 @@
 # coding: utf-8
 """Form
 """
-from itertools import tee, product, chain
+import random
+from array import array
+from functools import reduce
+from itertools import tee, product, islice
+from operator import mul
 
+from .covering import covering_array
 
-__all__ = ['Form']
+
+__all__ = ['Form', 'CaseBatch', 'Constraint', 'Allowed', 'Forbidden']
+
+BATCH_SIZE = 1024
 
 
 class Case(object):
     """Form Case
+
+    ``case`` is a tuple of ``(key, field case)``, shared with the other
+    cases of the same sub-product; ``label`` and ``values`` are only built
+    when they are accessed.
     """
-    def __init__(self, case):
-        self.priority = self._calc_priority([c.priority for _, c in case])
-        self.label = ' '.join(c.label for _, c in case)
-        self.values = {k: c.value for k, c in case}
+    __slots__ = ('index', 'priority', '_case', '_label', '_values')
+
+    def __init__(self, case, index=None, priority=None):
+        self.index = index
+        if priority is None:
+            priority = self._calc_priority([c.priority for _, c in case])
+        self.priority = priority
+        self._case = case
+        self._label = None
+        self._values = None
 
     def _calc_priority(self, priorities):
-        n_p0 = priorities.count('p0')
-        n_p1 = priorities.count('p1')
-        n_p2 = priorities.count('p2')
-        if n_p0 == len(priorities):
-            return 0
-        elif n_p1 == 1 and n_p2 == 0:
-            return 1
-        elif n_p1 == 0 and n_p2 == 1:
-            return 2
-        else:
-            return 3
+        return calc_priority(priorities)
+
+    @property
+    def label(self):
+        if self._label is None:
+            self._label = ' '.join(c.label for _, c in self._case)
+        return self._label
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = {k: c.value for k, c in self._case}
+        return self._values
 
     def __getitem__(self, key):
         return self.values[key]
@@ -39,62 +59,604 @@ class Case(object):
                                        self.priority, self.label)
 
 
+class CaseBatch(object):
+    """Cases of one sub-product, stored column-wise
+
+    ``columns`` holds the ``(key, field case)`` of every field, ``digits``
+    one array of indices into them per field. Priorities are computed for
+    the whole batch at once; ``Case`` objects are only created on access.
+
+    Cases are numbered from ``start``, or by ``indices`` if some of the
+    sub-product was left out.
+    """
+    def __init__(self, columns, rows, start=0, indices=None):
+        self.columns = columns
+        self.start = start
+        self.indices = indices
+        self.size = len(rows)
+        self.digits = [array('I', column) for column in zip(*rows)]
+        self.priorities = self._calc_priorities()
+
+    def _calc_priorities(self):
+        n_p1 = [0] * self.size
+        n_p2 = [0] * self.size
+        for column, digits in zip(self.columns, self.digits):
+            tags = [case.priority for _, case in column]
+            if 'p1' in tags:
+                n_p1 = [n + (tags[d] == 'p1') for n, d in zip(n_p1, digits)]
+            if 'p2' in tags:
+                n_p2 = [n + (tags[d] == 'p2') for n, d in zip(n_p2, digits)]
+        return array('B', [
+            0 if not p1 and not p2 else
+            1 if p1 == 1 and not p2 else
+            2 if p2 == 1 and not p1 else 3
+            for p1, p2 in zip(n_p1, n_p2)])
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.size:
+            raise IndexError('case index out of range')
+        case = tuple(column[digits[idx]]
+                     for column, digits in zip(self.columns, self.digits))
+        index = self.start + idx if self.indices is None else self.indices[idx]
+        return Case(case, index, self.priorities[idx])
+
+    def __iter__(self):
+        for idx in range(self.size):
+            yield self[idx]
+
+    def labels(self):
+        labels = [[case.label for _, case in column] for column in self.columns]
+        for idx in range(self.size):
+            yield ' '.join(label[digits[idx]]
+                           for label, digits in zip(labels, self.digits))
+
+
+class Constraint(object):
+    """Cases are valid only if ``predicate`` accepts the values of
+    ``fields``, in this order
+    """
+    def __init__(self, fields, predicate=None):
+        self.fields = tuple(fields)
+        if predicate is not None:
+            self.predicate = predicate
+
+    def check(self, values):
+        return self.predicate(*values)
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, ' '.join(self.fields))
+
+
+class Allowed(Constraint):
+    """The values of ``fields`` must be one of ``combinations``
+    """
+    def __init__(self, fields, combinations):
+        super(Allowed, self).__init__(fields)
+        self.combinations = set(map(tuple, combinations))
+
+    def check(self, values):
+        return tuple(values) in self.combinations
+
+
+class Forbidden(Allowed):
+    """The values of ``fields`` must not be any of ``combinations``
+    """
+    def check(self, values):
+        return tuple(values) not in self.combinations
+
+
+def calc_priority(priorities):
+    n_p0 = priorities.count('p0')
+    n_p1 = priorities.count('p1')
+    n_p2 = priorities.count('p2')
+    if n_p0 == len(priorities):
+        return 0
+    elif n_p1 == 1 and n_p2 == 0:
+        return 1
+    elif n_p1 == 0 and n_p2 == 1:
+        return 2
+    else:
+        return 3
+
+
 class Form(object):
     """Form
+
+    ``strength`` turns priority 3 into a covering array: instead of every
+    combination of all fields, only enough cases to cover each combination
+    of ``strength`` fields (2 for pairwise) are generated.
+
+    ``seed`` makes the random values of the fields reproducible: each field
+    draws from its own stream, derived from the seed and the field key.
+
+    The cases of the fields are cached; ``regenerate`` tells when their
+    random values are drawn again: ``'run'`` never (until ``refresh``),
+    ``'visit'`` every time the cases are iterated, or every ``N`` times.
+
+    ``constraints`` (``Constraint``, ``Allowed`` or ``Forbidden``) leave the
+    invalid combinations of values out: partial combinations are pruned as
+    soon as a constraint has all its fields, and cases are numbered and
+    counted without them.
     """
-    def __init__(self, fields):
+    def __init__(self, fields, strength=None, seed=None, regenerate='visit',
+                 constraints=()):
         self.fields = fields
+        self.strength = strength
+        self.regenerate = regenerate
+        self.constraints = list(constraints)
+        for constraint in self.constraints:
+            unknown = set(constraint.fields) - set(fields)
+            if unknown:
+                raise ValueError('Unknown fields in {!r}: {}'.format(
+                    constraint, ', '.join(sorted(unknown))))
+        self.visits = 0
+        self._columns = {}
+        if seed is not None:
+            self.reseed(seed)
 
-    def iter_cases(self, priority=1):
+    def reseed(self, seed):
+        for key, field in self.fields.items():
+            field.reseed('{}/{}'.format(seed, key))
+
+    def refresh(self):
+        for field in self.fields.values():
+            field.refresh()
+
+    def _visit(self):
+        regenerate = self.regenerate
+        if self.visits and (regenerate == 'visit' or (
+                regenerate != 'run' and self.visits % regenerate == 0)):
+            self.refresh()
+        self.visits += 1
+
+    def _column(self, key, field, include):
+        """Return the ``(key, case)`` of ``field`` for ``include``
+
+        Cached as long as the cases of the field are.
+        """
+        include = tuple(include or ['p0', 'p1'])
+        tables = [field.cases(priority) for priority in include]
+        cached = self._columns.get((key, include))
+        if cached is None or any(a is not b for a, b in zip(cached[0], tables)):
+            cached = self._columns[(key, include)] = (
+                tables, [(key, case) for table in tables for case in table])
+        return cached[1]
+
+    def iter_cases(self, priority=1, strength=None, seed=None, max_priority=None,
+                   pruned=None):
         """Return an iterator
 
         priority=0: only p0 values of each field
         priority=1: p0 + p1 values for one field, p0 values for others
         priority=2: p0 + p1 + p2 values for one field, p0 values for others
         priority=3: p0 + p1 + p2 values for all fields
+                    (``strength``-wise covering if ``strength`` is set)
+
+        Cases are streamed: only the values of each field are built ahead,
+        the combinations are yielded one by one. With ``seed``, the form is
+        reseeded before they are built.
+
+        With ``max_priority``, only the cases of at most this priority are
+        yielded, the others are not even built; cases keep their index.
+        ``pruned(count)`` is told how many were left out.
+        """
+        for batch in self.iter_batches(priority, strength, seed=seed,
+                                       max_priority=max_priority, pruned=pruned):
+            for case in batch:
+                yield case
+
+    def iter_batches(self, priority=1, strength=None, size=BATCH_SIZE,
+                     seed=None, max_priority=None, pruned=None):
+        """Return an iterator of ``CaseBatch`` of at most ``size`` cases
         """
         priority = max(0, priority)
-        fields = self.fields.items()
-        #return iter_cases(fields, priority)
-        case_gens = []
-        if priority >= 3:
-            case_gens.extend(product(*(
-                [(key, case) for case in field.iter_cases(['p0', 'p1', 'p2'])]
-                for key, field in fields))
-            )
+        if max_priority is not None and max_priority < 0:
+            if pruned is not None:
+                pruned(self.count_cases(priority, strength))
+            return
+        strength = strength or self.strength
+        if seed is not None:
+            # the values are the ones of the seed, whatever the visit
+            self.reseed(seed)
+            self.visits += 1
         else:
-            if priority >= 0:
-                case_gens.extend(product(*(
-                    [(key, case) for case in field.iter_cases(['p0'])]
-                    for key, field in fields))
-                )
-            if priority >= 1:
-                # def p1():
-                #     for name in self.fields.keys():
-                #         for case in product(*([(key, case)
-                #                                for case in field.iter_cases(1 if key == name else 0)]
-                #                               for key, field in fields)):
-                #             yield case
-                # cases = p1()
-                for name in self.fields.keys():
-                    case_gens.extend(product(*(
-                        [(key, case) for case in field.iter_cases(
-                                                ['p1' if key == name else 'p0'])]
-                        for key, field in fields))
-                    )
-            if priority >= 2:
-                for name in self.fields.keys():
-                    case_gens.extend(product(*(
-                        [(key, case) for case in field.iter_cases(
-                                                ['p2' if key == name else 'p0'])]
-                        for key, field in fields
-                    )))
-        return (Case(case) for case in chain(case_gens))
+            self._visit()
+        # built ahead, the form may be reseeded before the last batch; the
+        # columns of a tier are shared with the other tiers
+        tiers = [(tier, [self._column(key, field, include) for (key, field), include
+                         in zip(self.fields.items(), tier)])
+                 for tier in self._tiers(priority)]
+        index = 0
+        for tier, columns in tiers:
+            rows = self._rows(columns, priority, strength)
+            if max_priority is not None and max_priority < 3:
+                if priority < 3:
+                    # every case of the tier has the priority of the tier
+                    if tier_priority(tier) > max_priority:
+                        skipped = (reduce(mul, map(len, columns), 1)
+                                   if rows is None else sum(1 for _ in rows))
+                        index += skipped
+                        if pruned is not None:
+                            pruned(skipped)
+                        continue
+                else:
+                    if rows is not None:
+                        rows = list(rows)
+                    total = (reduce(mul, map(len, columns), 1)
+                             if rows is None else len(rows))
+                    indices, rows = capped_rows(columns, rows, max_priority)
+                    if pruned is not None:
+                        pruned(total - len(rows))
+                    for pos in range(0, len(rows), size):
+                        yield CaseBatch(columns, rows[pos:pos + size], index,
+                                        indices[pos:pos + size])
+                    continue
+            if rows is None:
+                rows = product(*(range(len(column)) for column in columns))
+            while True:
+                chunk = list(islice(rows, size))
+                if not chunk:
+                    break
+                yield CaseBatch(columns, chunk, index)
+                index += len(chunk)
+
+    def count_cases(self, priority=1, strength=None):
+        """Return the number of cases ``iter_cases`` would yield
+
+        The size of every sub-product is computed from the number of values
+        of each field, no case is generated (a covering array still has to
+        be built, but only as rows of indices).
+        """
+        priority = max(0, priority)
+        strength = strength or self.strength
+        return sum(len(rows) if rows is not None else reduce(mul, sizes, 1)
+                   for _, sizes, rows in self._tier_sizes(priority, strength))
+
+    def __len__(self):
+        """Number of cases of the default priority (1)
+        """
+        return self.count_cases()
+
+    def case_at(self, index, priority=1, strength=None, seed=None):
+        """Return the case at ``index`` of ``iter_cases(priority)``
+
+        The case is decoded from the index (mixed radix over the values of
+        each field), the cases before it are not generated.
+        """
+        priority = max(0, priority)
+        strength = strength or self.strength
+        if seed is not None:
+            self.reseed(seed)
+        return self._decode(index, self._tier_sizes(priority, strength))
+
+    def _decode(self, index, tiers):
+        """Return the case at ``index`` of the sub-products ``tiers``
+        """
+        if index < 0:
+            raise IndexError('case index out of range')
+        offset = 0
+        for tier, sizes, rows in tiers:
+            size = len(rows) if rows is not None else reduce(mul, sizes, 1)
+            if index < offset + size:
+                if rows is not None:
+                    digits = rows[index - offset]
+                else:
+                    digits = unrank(index - offset, sizes)
+                return self._make_case(tier, digits, index)
+            offset += size
+        raise IndexError('case index out of range')
+
+    def sample(self, n, priority=1, seed=None, stratified=False, strength=None):
+        """Return ``n`` distinct cases drawn at random, in index order
+
+        With ``stratified``, ``n`` is split evenly between case priorities
+        (p0, p1, p2 and p3 combinations), so that the rare low priority
+        cases are not drowned by the p3 ones.
+        """
+        priority = max(0, priority)
+        strength = strength or self.strength
+        rng = random.Random(seed)
+        # built once: rebuilding them for every case is slow with a
+        # covering array or constraints
+        tiers = list(self._tier_sizes(priority, strength))
+        if stratified:
+            strata = self._strata(priority, tiers)
+        else:
+            total = sum(len(rows) if rows is not None else reduce(mul, sizes, 1)
+                        for _, sizes, rows in tiers)
+            strata = [(total, lambda rng: rng.randrange(total))]
+        quotas = split_evenly(n, [size for size, _ in strata])
+        indices = set()
+        for (size, draw), quota in zip(strata, quotas):
+            if not stratified and quota * 2 > size:
+                indices.update(rng.sample(range(size), quota))
+                continue
+            chosen = set()
+            while len(chosen) < quota:
+                chosen.add(draw(rng))
+            indices.update(chosen)
+        return [self._decode(idx, tiers) for idx in sorted(indices)]
+
+    def _strata(self, priority, tiers):
+        """Return ``(size, draw)`` of each case priority of the sub-products
+        ``tiers``
+
+        ``draw(rng)`` returns the index of a random case of this priority.
+        """
+        if priority < 3:
+            # the sub-products of one priority are next to each other
+            strata = []
+            offset = 0
+            for stratum in range(priority + 1):
+                size = sum(len(rows) if rows is not None else reduce(mul, sizes, 1)
+                           for tier, sizes, rows in tiers
+                           if tier_priority(tier) == stratum)
+                strata.append((size, lambda rng, lo=offset, size=size:
+                                         lo + rng.randrange(size)))
+                offset += size
+            return [stratum for stratum in strata if stratum[0]]
+
+        fields = list(self.fields.values())
+        counts = [[field.count_cases([tag]) for tag in ['p0', 'p1', 'p2']]
+                  for field in fields]
+
+        def digits_priority(digits):
+            return calc_priority([
+                'p0' if digit < n0 else 'p1' if digit < n0 + n1 else 'p2'
+                for digit, (n0, n1, _) in zip(digits, counts)])
+
+        _, sizes, rows = tiers[0]
+        if rows is not None:
+            groups = [[] for _ in range(4)]
+            for idx, row in enumerate(rows):
+                groups[digits_priority(row)].append(idx)
+            return [(len(group), lambda rng, group=group: rng.choice(group))
+                    for group in groups if group]
+
+        # p0, p1 and p2 cases are small boxes of the full product
+        strata = []
+        p0 = [range(n0) for n0, _, _ in counts]
+        for stratum in range(3):
+            if stratum == 0:
+                boxes = [p0]
+            else:
+                boxes = []
+                for pos, (n0, n1, n2) in enumerate(counts):
+                    box = list(p0)
+                    box[pos] = (range(n0, n0 + n1) if stratum == 1
+                                else range(n0 + n1, n0 + n1 + n2))
+                    boxes.append(box)
+            strata.append(box_stratum(boxes, sizes))
+        # the p3 cases are everything else
+        size = reduce(mul, sizes, 1) - sum(size for size, _ in strata)
+
+        def draw_p3(rng):
+            while True:
+                idx = rng.randrange(reduce(mul, sizes, 1))
+                if digits_priority(unrank(idx, sizes)) == 3:
+                    return idx
+        strata.append((size, draw_p3))
+        return [stratum for stratum in strata if stratum[0]]
+
+    def _tier_sizes(self, priority, strength):
+        """Yield ``(tier, sizes, rows)`` of each sub-product
+
+        ``rows`` is the covering array or the valid rows of the
+        sub-product, if it is not the full product of ``sizes``.
+        """
+        for tier in self._tiers(priority):
+            columns = [self._column(key, field, include)
+                       for (key, field), include in zip(self.fields.items(), tier)]
+            rows = self._rows(columns, priority, strength)
+            if rows is not None:
+                rows = list(rows)
+            yield tier, [len(column) for column in columns], rows
+
+    def _rows(self, columns, priority, strength):
+        """Return an iterator of the rows of digits of a sub-product, or
+        ``None`` for the plain product of ``columns``
+        """
+        if priority >= 3 and strength:
+            return iter(covering_array(map(len, columns), strength,
+                                       self._checker(columns)))
+        if self.constraints:
+            return pruned_product(columns, self._checks(columns))
+        return None
+
+    def _checks(self, columns):
+        """Return the ``(positions, constraint)`` to check at each column:
+        the last one a constraint needs
+        """
+        keys = list(self.fields)
+        checks = [[] for _ in columns]
+        for constraint in self.constraints:
+            positions = [keys.index(key) for key in constraint.fields]
+            checks[max(positions)].append((positions, constraint))
+        return checks
+
+    def _checker(self, columns):
+        """Return ``valid(digits)`` of partial rows, or ``None`` without
+        constraints
+
+        A partial row is also rejected when a column left to ``None`` has
+        no value satisfying the constraints whose other fields are set: the
+        dead end is found before the other columns are tried.
+        """
+        if not self.constraints:
+            return None
+        checks = [check for checks in self._checks(columns) for check in checks]
+
+        def satisfied(positions, constraint, digits):
+            return constraint.check([columns[pos][digits[pos]][1].value
+                                     for pos in positions])
+
+        def valid(digits):
+            pending = {}
+            for positions, constraint in checks:
+                unset = [pos for pos in positions if digits[pos] is None]
+                if not unset:
+                    if not satisfied(positions, constraint, digits):
+                        return False
+                elif len(unset) == 1:
+                    pending.setdefault(unset[0], []).append((positions, constraint))
+            if not pending:
+                return True
+            digits = list(digits)
+            for pos, constraints in pending.items():
+                for digit in range(len(columns[pos])):
+                    digits[pos] = digit
+                    if all(satisfied(positions, constraint, digits)
+                           for positions, constraint in constraints):
+                        break
+                else:
+                    return False
+                digits[pos] = None
+            return True
+        return valid
+
+    def _make_case(self, tier, digits, index):
+        case = tuple(self._column(key, field, include)[digit]
+                     for (key, field), include, digit
+                     in zip(self.fields.items(), tier, digits))
+        return Case(case, index)
+
+    def _tiers(self, priority):
+        """Yield the ``include`` list of every field for each sub-product
+        """
+        keys = list(self.fields)
+        if priority >= 3:
+            yield [['p0', 'p1', 'p2']] * len(keys)
+            return
+        yield [['p0']] * len(keys)
+        for tag in ['p1', 'p2'][:priority]:
+            for name in keys:
+                yield [[tag] if key == name else ['p0'] for key in keys]
 
     def list_cases(self, priority=1):
         return list(self.iter_cases(priority))
 
 
+def unrank(rank, sizes):
+    """Decode ``rank`` into one digit per size, the last one varying fastest
+    """
+    digits = []
+    for size in reversed(sizes):
+        rank, digit = divmod(rank, size)
+        digits.append(digit)
+    return digits[::-1]
+
+
+def capped_rows(columns, rows, max_priority):
+    """Return the indices and the rows of digits of the cases of at most
+    ``max_priority`` (below 3) among ``rows``
+
+    ``rows`` is ``None`` for the full product of ``columns``: the p0, p1 and
+    p2 cases are then the boxes where at most one column is not p0.
+    """
+    tags = [[case.priority for _, case in column] for column in columns]
+    if rows is not None:
+        found = [(idx, row) for idx, row in enumerate(rows)
+                 if calc_priority([tag[digit] for tag, digit
+                                   in zip(tags, row)]) <= max_priority]
+    else:
+        sizes = [len(column) for column in columns]
+        ranges = {
+            tag: [range(column.index(tag), column.index(tag) + column.count(tag))
+                  if tag in column else range(0) for column in tags]
+            for tag in ['p0', 'p1', 'p2']}
+        boxes = [ranges['p0']]
+        for tag in ['p1', 'p2'][:max_priority]:
+            for pos in range(len(columns)):
+                box = list(ranges['p0'])
+                box[pos] = ranges[tag][pos]
+                boxes.append(box)
+        found = sorted((rank(row, sizes), row)
+                       for box in boxes for row in product(*box))
+    return [idx for idx, _ in found], [row for _, row in found]
+
+
+def pruned_product(columns, checks):
+    """Yield the rows of digits of the product of ``columns`` (in the order
+    of ``itertools.product``) that pass ``checks``
+
+    ``checks[pos]`` holds the ``(positions, constraint)`` to check once the
+    digit at ``pos`` is set: a partial row failing one is not extended.
+    """
+    sizes = [len(column) for column in columns]
+    if not sizes or 0 in sizes:
+        return
+    values = [[case.value for _, case in column] for column in columns]
+    last = len(sizes) - 1
+    digits = [-1] * len(sizes)
+    pos = 0
+    while pos >= 0:
+        digits[pos] += 1
+        if digits[pos] == sizes[pos]:
+            digits[pos] = -1
+            pos -= 1
+            continue
+        if not all(constraint.check([values[p][digits[p]] for p in positions])
+                   for positions, constraint in checks[pos]):
+            continue
+        if pos == last:
+            yield tuple(digits)
+        else:
+            pos += 1
+
+
+def rank(digits, sizes):
+    result = 0
+    for digit, size in zip(digits, sizes):
+        result = result * size + digit
+    return result
+
+
+def tier_priority(tier):
+    return calc_priority([include[0] for include in tier])
+
+
+def box_stratum(boxes, sizes):
+    """Return ``(size, draw)`` of the union of disjoint ``boxes``
+
+    A box is a range of digits for each column of a product of ``sizes``.
+    """
+    box_sizes = [reduce(mul, map(len, box), 1) for box in boxes]
+    total = sum(box_sizes)
+
+    def draw(rng):
+        offset = rng.randrange(total)
+        for box, size in zip(boxes, box_sizes):
+            if offset < size:
+                digits = [r[d] for r, d in
+                          zip(box, unrank(offset, [len(r) for r in box]))]
+                return rank(digits, sizes)
+            offset -= size
+    return total, draw
+
+
+def split_evenly(n, sizes):
+    """Split ``n`` between ``sizes``, giving what a small one can't take
+    to the others
+    """
+    quotas = [0] * len(sizes)
+    left = n
+    open_ = [i for i, size in enumerate(sizes) if size > 0]
+    while left > 0 and open_:
+        share = max(1, left // len(open_))
+        for i in list(open_):
+            take = min(share, sizes[i] - quotas[i], left)
+            quotas[i] += take
+            left -= take
+            if quotas[i] == sizes[i]:
+                open_.remove(i)
+            if not left:
+                break
+    return quotas
+
+
 class NoMoreField(Exception):
     """No more field in ``other``
     """
@@ -0,0 +1,180 @@
+# coding: utf-8
+"""Edges of the routes and their export
+"""
+import json
+import math
+from bisect import bisect_right
+from xml.sax.saxutils import escape, quoteattr
+
+
+__all__ = ['RouteSet', 'EdgeIndex', 'write_dot', 'write_json', 'write_graphml']
+
+
+class RouteSet(object):
+    """Route ids, stored as sorted ``[first, last]`` ranges
+
+    Routes are numbered in the order they end, so adding ids to an edge
+    mostly extends its last range.
+    """
+    __slots__ = ('ranges',)
+
+    def __init__(self, ids=()):
+        self.ranges = []
+        for route_id in ids:
+            self.add(route_id)
+
+    def add(self, route_id):
+        ranges = self.ranges
+        if ranges and ranges[-1][1] + 1 == route_id:
+            ranges[-1][1] = route_id
+        elif not ranges or ranges[-1][1] < route_id:
+            ranges.append([route_id, route_id])
+        else:
+            pos = bisect_right([first for first, _ in ranges], route_id)
+            if pos and ranges[pos - 1][1] >= route_id:
+                return
+            ranges.insert(pos, [route_id, route_id])
+            self._join(pos)
+            self._join(pos - 1)
+
+    def update(self, other):
+        merged = []
+        for first, last in sorted(self.ranges + other.ranges):
+            if merged and merged[-1][1] + 1 >= first:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        self.ranges = merged
+
+    def _join(self, pos):
+        """Merge the range at ``pos`` with the next one if they touch
+        """
+        ranges = self.ranges
+        if 0 <= pos < len(ranges) - 1 and ranges[pos][1] + 1 >= ranges[pos + 1][0]:
+            ranges[pos][1] = max(ranges[pos][1], ranges[pos + 1][1])
+            del ranges[pos + 1]
+
+    def labels(self):
+        return ['({})'.format(first if first == last
+                              else '{}-{}'.format(first, last))
+                for first, last in self.ranges]
+
+    def __iter__(self):
+        for first, last in self.ranges:
+            for route_id in range(first, last + 1):
+                yield route_id
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.ranges)
+
+    def __contains__(self, route_id):
+        pos = bisect_right([first for first, _ in self.ranges], route_id)
+        return bool(pos) and self.ranges[pos - 1][1] >= route_id
+
+    def __str__(self):
+        return ''.join(self.labels())
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self)
+
+
+class EdgeIndex(object):
+    """``RouteSet`` of every ``(start, end)`` edge, filled as routes end
+
+    Steps are keyed by name, the way they are drawn.
+    """
+    def __init__(self):
+        self.edges = {}
+
+    def add_route(self, route_id, start, steps):
+        for end in steps:
+            key = (str(start), str(end))
+            route_ids = self.edges.get(key)
+            if route_ids is None:
+                route_ids = self.edges[key] = RouteSet()
+            route_ids.add(route_id)
+            start = end
+
+    def by_start(self):
+        """Return the edges grouped by start step
+        """
+        groups = {}
+        for start, end, route_ids in self:
+            groups.setdefault(start, []).append((start, end, route_ids))
+        return groups
+
+    def __iter__(self):
+        for (start, end), route_ids in self.edges.items():
+            yield start, end, route_ids
+
+    def __len__(self):
+        return len(self.edges)
+
+
+def write_dot(edges, stream):
+    stream.write('digraph {\n')
+    stream.write('node [shape="box"];\n')
+    stream.write('edge [fontsize="12" fontcolor="blue"];\n')
+    for start, end, route_ids in edges:
+        stream.write('"{}" -> "{}" [ label = "{}" ]\n'.format(
+            Z(start), Z(end), make_square(route_ids)))
+    stream.write('}')
+
+
+def write_json(edges, stream):
+    stream.write('{"edges": [')
+    for idx, (start, end, route_ids) in enumerate(edges):
+        if idx:
+            stream.write(',')
+        stream.write('\n')
+        stream.write(json.dumps({
+            'source': str(start),
+            'target': str(end),
+            'routes': route_ids.ranges if isinstance(route_ids, RouteSet)
+                      else sorted(route_ids),
+        }, ensure_ascii=False))
+    stream.write('\n]}')
+
+
+def write_graphml(edges, stream):
+    stream.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    stream.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+    stream.write('<key id="routes" for="edge" attr.name="routes" '
+                 'attr.type="string"/>\n')
+    stream.write('<graph edgedefault="directed">\n')
+    nodes = set()
+    for start, end, route_ids in edges:
+        for name in (str(start), str(end)):
+            if name not in nodes:
+                nodes.add(name)
+                stream.write('<node id={}/>\n'.format(quoteattr(name)))
+        stream.write('<edge source={} target={}>'.format(
+            quoteattr(str(start)), quoteattr(str(end))))
+        stream.write('<data key="routes">{}</data></edge>\n'.format(
+            escape(str(route_ids if isinstance(route_ids, RouteSet)
+                       else RouteSet(sorted(route_ids))))))
+    stream.write('</graph>\n</graphml>\n')
+
+
+def make_square(items):
+    if isinstance(items, RouteSet):
+        chunks = items.labels()
+    else:
+        chunks = ['({})'.format(item) for item in items]
+    width = max(int(math.sqrt(sum(map(len, chunks)) * 2 / 0.618)), 12)
+    lines, line, pos = [], [], 0
+    for chunk in chunks:
+        if line and pos + len(chunk) > width:
+            lines.append(''.join(line))
+            line, pos = [], 0
+        line.append(chunk)
+        pos += len(chunk)
+    lines.append(''.join(line))
+    return '\n'.join(lines)
+
+
+def Z(text):
+    if not text:
+        return text
+    text = str(text)
+    return '\n'.join(text.split()).replace('\\', '\\\\')
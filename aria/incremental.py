@@ -0,0 +1,189 @@
+# coding: utf-8
+"""Routes of a previous walk, reused where the steps did not change
+"""
+import hashlib
+import importlib
+import io
+import json
+import os
+import types
+
+
+__all__ = ['WalkCache', 'fingerprint', 'class_key']
+
+CACHE_VERSION = 1
+SIMPLE_TYPES = (str, int, float, bool, type(None), tuple, frozenset)
+
+
+def class_key(cls):
+    return '{}.{}'.format(cls.__module__, cls.__qualname__)
+
+
+def step_class(step):
+    """Return the key of the class of ``step``, ``None`` for an outcome
+    """
+    if not callable(getattr(step, 'run', None)):
+        return None
+    return class_key(step.__class__)
+
+
+def fingerprint(cls):
+    """Return a hash of the code and the forms of the step class ``cls``
+
+    It covers every class of its MRO: the bytecode of their functions,
+    their forms and their plain attributes.
+    """
+    digest = hashlib.sha1()
+    for klass in cls.__mro__:
+        if klass is object:
+            continue
+        digest.update(class_key(klass).encode('utf-8'))
+        for name, value in sorted(vars(klass).items()):
+            if name.startswith('__'):
+                continue
+            func = getattr(value, '__func__', value)
+            if isinstance(func, types.FunctionType):
+                digest.update(name.encode('utf-8'))
+                update_code(digest, func.__code__)
+            elif hasattr(value, 'fields') and hasattr(value, 'iter_cases'):
+                digest.update(name.encode('utf-8'))
+                update_form(digest, value)
+            elif isinstance(value, SIMPLE_TYPES):
+                digest.update('{}={!r}'.format(name, value).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def update_code(digest, code):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode('utf-8'))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            update_code(digest, const)
+        else:
+            digest.update(repr(const).encode('utf-8'))
+
+
+def update_form(digest, form):
+    digest.update(repr(form.strength).encode('utf-8'))
+    for key, field in form.fields.items():
+        attrs = sorted((name, repr(value)) for name, value in vars(field).items()
+                       if not name.startswith('_') and name != 'seed')
+        digest.update(repr((key, class_key(field.__class__), attrs)).encode('utf-8'))
+    for constraint in getattr(form, 'constraints', ()):
+        digest.update(repr((class_key(constraint.__class__), constraint.fields,
+                            sorted(getattr(constraint, 'combinations', ()),
+                                   key=repr))).encode('utf-8'))
+        predicate = getattr(constraint, 'predicate', None)
+        if isinstance(predicate, types.FunctionType):
+            update_code(digest, predicate.__code__)
+
+
+def current_fingerprint(key):
+    """Return the fingerprint of the class ``key`` as it is now, ``None``
+    if it can't be found
+    """
+    module, _, qualname = key.rpartition('.')
+    while module:
+        try:
+            obj = importlib.import_module(module)
+            break
+        except ImportError:
+            module, _, outer = module.rpartition('.')
+            qualname = outer + '.' + qualname
+    else:
+        return None
+    for name in qualname.split('.'):
+        obj = getattr(obj, name, None)
+        if obj is None:
+            return None
+    return fingerprint(obj) if isinstance(obj, type) else None
+
+
+class WalkCache(object):
+    """Routes of the last complete walk and the fingerprints of their steps
+
+    A subtree can be reused when every step class in it has the same
+    fingerprint as when it was walked; the others are walked again.
+    """
+    def __init__(self, path, first_step, priority, options):
+        self.path = path
+        self.key = {'first_step': class_key(first_step.__class__),
+                    'priority': priority,
+                    'options': {name: repr(value)
+                                for name, value in sorted(options.items())}}
+        self.records = []
+        self.fingerprints = {}
+        self._old = []
+        self._subtrees = {}
+        self._changed = set()
+        self._known = set()
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with io.open(self.path, encoding='utf-8') as f:
+            try:
+                data = json.load(f)
+            except ValueError:
+                return
+        if data.get('version') != CACHE_VERSION or data.get('key') != self.key:
+            return
+        # sorted by path, each subtree is a slice of the routes
+        self._old = sorted(data['routes'], key=lambda record: record['path'])
+        for idx, record in enumerate(self._old):
+            path = record['path']
+            for depth in range(len(path)):
+                span = self._subtrees.setdefault(tuple(path[:depth]), [idx, idx])
+                span[1] = idx
+        self._known = set(data['fingerprints'])
+        self._changed = {key for key, value in data['fingerprints'].items()
+                         if current_fingerprint(key) != value}
+
+    def _stale(self, key):
+        return key is not None and (key in self._changed
+                                    or key not in self._known)
+
+    def reusable(self, path, step):
+        """Return the records of the routes after ``path`` (case indices),
+        reached on ``step``, if they were reached on the same step and none
+        of their steps changed, else ``None``
+        """
+        span = self._subtrees.get(tuple(path))
+        if span is None:
+            return None
+        key = step_class(step)
+        if key is None or self._stale(key):
+            return None
+        depth = len(path)
+        records = self._old[span[0]:span[1] + 1]
+        for record in records:
+            if depth:
+                node = record['nodes'][depth - 1]
+                if node.get('class') != key or node['step'] != str(step):
+                    return None
+            for node in record['nodes'][depth:]:
+                if self._stale(node.get('class')):
+                    return None
+        return records
+
+    def add(self, record, step):
+        """Keep ``record`` of the walk; ``step`` is the first step
+        """
+        self.records.append(record)
+        for key in [step_class(step)] + [node.get('class')
+                                         for node in record['nodes']]:
+            if key is not None and key not in self.fingerprints:
+                fp = current_fingerprint(key)
+                if fp is not None:
+                    self.fingerprints[key] = fp
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'version': CACHE_VERSION, 'key': self.key,
+                                'fingerprints': self.fingerprints,
+                                'routes': sorted(self.records,
+                                                 key=lambda r: r['path'])},
+                               ensure_ascii=False, default=repr))
+        os.replace(tmp_path, self.path)
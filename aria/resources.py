@@ -0,0 +1,119 @@
+# coding: utf-8
+"""Resources shared by the steps of a walk
+"""
+import pickle
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+from uuid import uuid4
+
+
+__all__ = ['ResourcePool']
+
+_process_pools = {}
+
+
+class ResourcePool(object):
+    """Named resources (connections, sessions, clients...) lent to steps
+
+    ``register`` a factory per name: ``borrow`` returns an idle resource or
+    creates one, ``give_back`` makes it idle again, ``close`` closes them
+    all. Only the factories are pickled: a pool sent to worker processes
+    creates its resources once per process (see ``for_process``) and
+    closes them when the process exits. Factories borrowed from in
+    worker processes must therefore be picklable: the others can't be
+    borrowed there.
+    """
+    def __init__(self):
+        self.token = uuid4().hex
+        self.factories = {}
+        self._origin = True
+        self._reset()
+
+    def _reset(self):
+        self._idle = defaultdict(list)
+        self._created = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def register(self, name, factory, close=None):
+        """``factory()`` creates a resource, ``close(resource)`` closes it
+        (defaults to its ``close`` method, if any)
+        """
+        self.factories[name] = (factory, close)
+
+    def borrow(self, name):
+        with self._lock:
+            if self._idle[name]:
+                return self._idle[name].pop()
+        if name not in self.factories:
+            raise KeyError('No resource named {!r}'.format(name))
+        if self.factories[name] is None:
+            raise ValueError('The factory of {!r} could not be pickled for '
+                             'this worker process'.format(name))
+        resource = self.factories[name][0]()
+        with self._lock:
+            self._created[name].append(resource)
+        return resource
+
+    def give_back(self, name, resource):
+        with self._lock:
+            self._idle[name].append(resource)
+
+    @contextmanager
+    def lease(self, name):
+        resource = self.borrow(name)
+        try:
+            yield resource
+        finally:
+            self.give_back(name, resource)
+
+    def created(self, name):
+        """Return how many ``name`` resources were created
+        """
+        return len(self._created[name])
+
+    def close(self):
+        with self._lock:
+            created, self._created = self._created, defaultdict(list)
+            self._idle = defaultdict(list)
+        for name, resources in created.items():
+            close = self.factories[name][1]
+            for resource in resources:
+                if close is not None:
+                    close(resource)
+                elif callable(getattr(resource, 'close', None)):
+                    resource.close()
+
+    def for_process(self):
+        """Return the pool of this process with the same ``token``: the
+        first copy sent to a worker process is kept for the next tasks
+        """
+        if self._origin:
+            return self
+        pool = _process_pools.get(self.token)
+        if pool is None:
+            pool = _process_pools[self.token] = self
+            Finalize(None, pool.close, exitpriority=10)
+        return pool
+
+    def for_workers(self):
+        """Return the pool to send to worker processes, ``None`` if it has
+        no factories
+        """
+        return self if self.factories else None
+
+    def __getstate__(self):
+        factories = {}
+        for name, factory in self.factories.items():
+            try:
+                pickle.dumps(factory)
+            except (pickle.PicklingError, AttributeError, TypeError):
+                factory = None
+            factories[name] = factory
+        return {'token': self.token, 'factories': factories}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._origin = False
+        self._reset()
@@ -0,0 +1,103 @@
+# coding: utf-8
+"""Routes found by a walk, stored as a trie of shared prefixes
+"""
+from collections import namedtuple
+
+
+__all__ = ['Node', 'TrieNode', 'RouteTrie']
+
+
+Node = namedtuple('Node', ('case', 'step'))
+
+
+class TrieNode(object):
+    """A case and the step (or outcome) it led to, shared by every route
+    going through it
+
+    Unpacks like ``Node``.
+    """
+    __slots__ = ('case', 'step', 'parent', 'children', 'route_id')
+
+    def __init__(self, case, step, parent=None):
+        self.case = case
+        self.step = step
+        self.parent = parent
+        self.children = []
+        self.route_id = None
+
+    def __iter__(self):
+        yield self.case
+        yield self.step
+
+    def __repr__(self):
+        return '<{} {!r} -> {}>'.format(self.__class__.__name__,
+                                        self.case, self.step)
+
+
+class RouteTrie(object):
+    """Routes as paths from ``root`` to numbered leaves
+
+    Without ``keep``, nodes only point to their parent: a route is dropped
+    as soon as the walker leaves it.
+    """
+    def __init__(self, first_step=None, keep=True):
+        self.root = TrieNode(None, first_step)
+        self.leaves = []
+        self.keep = keep
+        self.size = 0
+
+    def add(self, parent, case, step):
+        """Return a new node under ``parent`` (the root if ``None``)
+        """
+        node = TrieNode(case, step, parent or self.root)
+        if self.keep:
+            node.parent.children.append(node)
+            self.size += 1
+        return node
+
+    def end(self, leaf, route_id):
+        leaf.route_id = route_id
+        if self.keep:
+            self.leaves.append(leaf)
+
+    def graft(self, route):
+        """Add ``route`` (a list of ``Node``), sharing the nodes already
+        there, and return its leaf
+        """
+        parent = self.root
+        for depth, (case, step) in enumerate(route):
+            last = depth == len(route) - 1
+            node = None
+            if not last:
+                node = next((child for child in reversed(parent.children)
+                             if child.route_id is None
+                             and same_node(child, case, step)), None)
+            parent = node or self.add(parent, case, step)
+        return parent
+
+    def path(self, leaf):
+        """Return the nodes from the root to ``leaf``
+        """
+        nodes = []
+        while leaf is not None and leaf is not self.root:
+            nodes.append(leaf)
+            leaf = leaf.parent
+        nodes.reverse()
+        return nodes
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def __iter__(self):
+        for leaf in self.leaves:
+            yield self.path(leaf)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.path(leaf) for leaf in self.leaves[idx]]
+        return self.path(self.leaves[idx])
+
+
+def same_node(node, case, step):
+    return (node.case.index == case.index and node.case.label == case.label
+            and str(node.step) == str(step))
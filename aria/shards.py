@@ -0,0 +1,59 @@
+# coding: utf-8
+"""Walks split between machines, and the merge of their routes
+"""
+import argparse
+import zlib
+
+from .sinks import open_sink
+
+
+__all__ = ['shard_of', 'merge_shards']
+
+
+def shard_of(path, count):
+    """Return the shard (``0`` to ``count - 1``) of the route ``path``
+
+    The hash is stable: every machine computes the same shard.
+    """
+    return zlib.crc32(','.join(map(str, path)).encode('ascii')) % count
+
+
+def merge_shards(sources, sink=None):
+    """Return the records of the shard sinks (or paths) ``sources``,
+    numbered as a walk on one machine would have numbered them
+
+    Walks go through the cases in index order, so the routes are sorted by
+    path. The records are also written to ``sink``, if any.
+    """
+    records = []
+    for source in sources:
+        source = open_sink(source)
+        try:
+            records.extend(source.records())
+        finally:
+            source.close()
+    records.sort(key=lambda record: record['path'])
+    target = open_sink(sink) if sink is not None else None
+    try:
+        for number, record in enumerate(records, 1):
+            record['id'] = number
+            if target is not None:
+                target.write(record)
+    finally:
+        if target is not None:
+            target.close()
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Merge the route files of a sharded walk')
+    parser.add_argument('output', help='route file to write')
+    parser.add_argument('shards', nargs='+', help='route files of the shards')
+    args = parser.parse_args(argv)
+    records = merge_shards(args.shards, args.output)
+    print('{} routes merged into {}'.format(len(records), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+# coding: utf-8
+"""Route sinks: where ``Flow`` writes every route as soon as it ends
+"""
+import base64
+import io
+import json
+import os
+import pickle
+import sqlite3
+from collections import namedtuple
+
+from .incremental import step_class
+from .routes import Node
+
+
+__all__ = ['RouteSink', 'JsonLinesSink', 'SQLiteSink', 'open_sink',
+           'dump_route', 'load_route', 'encode_value', 'decode_value']
+
+
+RecordedCase = namedtuple('RecordedCase', ('index', 'label', 'priority', 'values'))
+
+TAGS = ('__tuple__', '__dict__', '__pickle__', '__repr__')
+
+
+def encode_value(value):
+    """Return ``value`` as JSON that ``decode_value`` turns back into it
+
+    Lists, strings, numbers and dicts of strings stay as they are; tuples
+    and other dicts are tagged, other values are pickled. A value that
+    can't be pickled is kept as its ``repr``, and can't be replayed.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if type(value) is list:
+        return [encode_value(item) for item in value]
+    if type(value) is tuple:
+        return {'__tuple__': [encode_value(item) for item in value]}
+    if type(value) is dict:
+        if all(isinstance(key, str) for key in value) and not (
+                len(value) == 1 and next(iter(value)) in TAGS):
+            return {key: encode_value(item) for key, item in value.items()}
+        return {'__dict__': [[encode_value(key), encode_value(item)]
+                             for key, item in value.items()]}
+    try:
+        data = pickle.dumps(value)
+    except Exception:
+        return {'__repr__': repr(value)}
+    return {'__pickle__': base64.b64encode(data).decode('ascii')}
+
+
+def decode_value(value):
+    """Return the value encoded by ``encode_value``
+    """
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        tag, item = next(iter(value.items()))
+        if tag == '__tuple__':
+            return tuple(decode_value(i) for i in item)
+        if tag == '__dict__':
+            return {decode_value(k): decode_value(v) for k, v in item}
+        if tag == '__pickle__':
+            return pickle.loads(base64.b64decode(item))
+        if tag == '__repr__':
+            return item
+    return {key: decode_value(item) for key, item in value.items()}
+
+
+def dump_route(number, route):
+    """Return the JSON record of the route ``number``
+
+    Each node keeps the case (label, priority, index and values, encoded
+    by ``encode_value``), the name of the step or the outcome it led to and
+    the class of the step. ``path`` is the index of every case, in the
+    order they were run.
+    """
+    return {
+        'id': number,
+        'path': [node.case.index for node in route],
+        'nodes': [{
+            'label': node.case.label,
+            'priority': node.case.priority,
+            'index': node.case.index,
+            'values': encode_value(node.case.values),
+            'step': str(node.step),
+            'class': step_class(node.step),
+        } for node in route],
+    }
+
+
+def load_route(record):
+    """Return the route of a record written by ``dump_route``
+
+    Cases are ``RecordedCase`` and steps are their names.
+    """
+    return [Node(RecordedCase(node['index'], node['label'], node['priority'],
+                              decode_value(node['values'])), node['step'])
+            for node in record['nodes']]
+
+
+class RouteSink(object):
+    """Base
+    """
+    def write(self, record):
+        raise NotImplementedError()
+
+    def records(self):
+        """Return an iterator of the records written so far
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def last(self):
+        record = None
+        for record in self.records():
+            pass
+        return record
+
+
+class JsonLinesSink(RouteSink):
+    """Append-only file with a JSON record per line
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def write(self, record):
+        if self._file is None:
+            self._cut_tail()
+            self._file = io.open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(record, ensure_ascii=False, default=repr))
+        self._file.write(u'\n')
+        self._file.flush()
+
+    def _cut_tail(self):
+        """Drop a line cut by a crash: the next record starts a new line
+        """
+        if not os.path.exists(self.path):
+            return
+        with io.open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            end = position = f.tell()
+            while position:
+                step = min(position, 4096)
+                f.seek(position - step)
+                newline = f.read(step).rfind(b'\n')
+                if newline >= 0:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            if position != end:
+                f.truncate(position)
+
+    def records(self):
+        if not os.path.exists(self.path):
+            return
+        with io.open(self.path, encoding='utf-8') as lines:
+            for line in lines:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    """a line cut by a crash"""
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SQLiteSink(RouteSink):
+    """SQLite database with a row per route
+    """
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute('CREATE TABLE IF NOT EXISTS routes '
+                             '(id INTEGER PRIMARY KEY, record TEXT)')
+        return self._db
+
+    def write(self, record):
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO routes (id, record) VALUES (?, ?)',
+                (record['id'], json.dumps(record, default=repr)))
+
+    def records(self):
+        for (record,) in self.db.execute('SELECT record FROM routes ORDER BY id'):
+            yield json.loads(record)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def open_sink(path):
+    """Return the sink of ``path``: SQLite for ``.db``/``.sqlite`` files,
+    JSON lines otherwise
+    """
+    if isinstance(path, RouteSink):
+        return path
+    if os.path.splitext(path)[1] in ('.db', '.sqlite', '.sqlite3'):
+        return SQLiteSink(path)
+    return JsonLinesSink(path)
@@ -0,0 +1,199 @@
+# coding: utf-8
+"""Instrumentation of walks
+"""
+import json
+import tracemalloc
+
+
+__all__ = ['Instrument', 'WalkStats']
+
+BUCKETS = (0.001, 0.01, 0.1, 1, 10, 60)
+
+
+class Instrument(object):
+    """Hooks called by ``Flow`` when it is given an instrument
+
+    Without an instrument, the walker does not even read the clock.
+    """
+    def step_run(self, step, seconds, replay):
+        """``step.run`` took ``seconds``, to replay a route or not
+        """
+
+    def case_generated(self, seconds):
+        """A case took ``seconds`` to generate
+        """
+
+    def pruned(self, count):
+        """A form left out ``count`` cases over the priority of the route,
+        without generating them
+        """
+
+    def route_ended(self, route_id, depth, nodes):
+        """Route ``route_id`` of ``depth`` steps ended, the routes hold
+        ``nodes`` nodes
+        """
+
+    def logged(self, seconds):
+        """A line of the walk log took ``seconds``
+        """
+
+    def fork(self):
+        """Return a new instrument for a worker process of a parallel walk,
+        or ``None`` to leave the workers out
+        """
+        return None
+
+    def merge(self, other):
+        """Add the counters of ``other``, returned by ``fork`` and used by
+        a worker; its routes are told again by ``route_ended`` as they are
+        merged
+        """
+
+
+class StepStats(object):
+    """Calls and latency histogram of a step class
+    """
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.calls += 1
+        self.seconds += seconds
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            idx = len(BUCKETS)
+        self.buckets[idx] += 1
+
+    def to_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds,
+                'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'],
+                                    self.buckets))}
+
+
+class WalkStats(Instrument):
+    """Counters of a walk, exportable as JSON and Prometheus text
+    """
+    def __init__(self):
+        self.steps = {}
+        self.explore_seconds = 0.0
+        self.replay_seconds = 0.0
+        self.replays = 0
+        self.cases_generated = 0
+        self.cases_pruned = 0
+        self.generate_seconds = 0.0
+        self.log_seconds = 0.0
+        self.routes = 0
+        self.peak_depth = 0
+        self.route_nodes = 0
+        self.peak_memory = None
+
+    def step_run(self, step, seconds, replay):
+        name = step.__class__.__name__
+        if name not in self.steps:
+            self.steps[name] = StepStats()
+        self.steps[name].add(seconds)
+        if replay:
+            self.replays += 1
+            self.replay_seconds += seconds
+        else:
+            self.explore_seconds += seconds
+
+    def case_generated(self, seconds):
+        self.cases_generated += 1
+        self.generate_seconds += seconds
+
+    def pruned(self, count):
+        self.cases_pruned += count
+
+    def route_ended(self, route_id, depth, nodes):
+        self.routes += 1
+        self.peak_depth = max(self.peak_depth, depth)
+        self.route_nodes = nodes
+        if tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+
+    def logged(self, seconds):
+        self.log_seconds += seconds
+
+    def fork(self):
+        return WalkStats()
+
+    def merge(self, other):
+        for name, stats in other.steps.items():
+            mine = self.steps.setdefault(name, StepStats())
+            mine.calls += stats.calls
+            mine.seconds += stats.seconds
+            mine.buckets = [a + b for a, b in zip(mine.buckets, stats.buckets)]
+        self.explore_seconds += other.explore_seconds
+        self.replay_seconds += other.replay_seconds
+        self.replays += other.replays
+        self.cases_generated += other.cases_generated
+        self.cases_pruned += other.cases_pruned
+        self.generate_seconds += other.generate_seconds
+        self.log_seconds += other.log_seconds
+
+    def to_dict(self):
+        return {
+            'steps': {name: stats.to_dict() for name, stats in self.steps.items()},
+            'explore_seconds': self.explore_seconds,
+            'replay_seconds': self.replay_seconds,
+            'replays': self.replays,
+            'cases_generated': self.cases_generated,
+            'cases_pruned': self.cases_pruned,
+            'generate_seconds': self.generate_seconds,
+            'log_seconds': self.log_seconds,
+            'routes': self.routes,
+            'peak_depth': self.peak_depth,
+            'route_nodes': self.route_nodes,
+            'peak_memory': self.peak_memory,
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix='aria'):
+        lines = []
+
+        def metric(name, kind, value, help_text):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            lines.append('{}_{} {}'.format(prefix, name, value))
+
+        name = '{}_step_seconds'.format(prefix)
+        lines.append('# HELP {} Duration of Step.run'.format(name))
+        lines.append('# TYPE {} histogram'.format(name))
+        for step, stats in sorted(self.steps.items()):
+            count = 0
+            for bound, hits in zip(BUCKETS + ('+Inf',), stats.buckets):
+                count += hits
+                lines.append('{}_bucket{{step="{}",le="{}"}} {}'.format(
+                    name, step, bound, count))
+            lines.append('{}_sum{{step="{}"}} {}'.format(name, step, stats.seconds))
+            lines.append('{}_count{{step="{}"}} {}'.format(name, step, stats.calls))
+        metric('explore_seconds_total', 'counter', self.explore_seconds,
+               'Time spent in Step.run for new cases')
+        metric('replay_seconds_total', 'counter', self.replay_seconds,
+               'Time spent in Step.run to replay routes')
+        metric('replays_total', 'counter', self.replays,
+               'Step.run calls to replay routes')
+        metric('cases_generated_total', 'counter', self.cases_generated,
+               'Cases generated by the forms')
+        metric('cases_pruned_total', 'counter', self.cases_pruned,
+               'Cases over the priority of their route')
+        metric('generate_seconds_total', 'counter', self.generate_seconds,
+               'Time spent generating cases')
+        metric('log_seconds_total', 'counter', self.log_seconds,
+               'Time spent logging')
+        metric('routes_total', 'counter', self.routes, 'Routes found')
+        metric('route_peak_depth', 'gauge', self.peak_depth,
+               'Steps of the longest route')
+        metric('route_nodes', 'gauge', self.route_nodes,
+               'Nodes kept by the routes')
+        if self.peak_memory is not None:
+            metric('peak_memory_bytes', 'gauge', self.peak_memory,
+                   'Peak memory traced by tracemalloc')
+        return '\n'.join(lines) + '\n'
@@ -1,28 +1,46 @@
 # coding: utf-8
 """Walk through the work flow
 """
+import asyncio
+import copy
+import heapq
+import inspect
 import logging
-import math
+import io
 import os
 import subprocess
-from collections import defaultdict, namedtuple
-from io import StringIO
+import sys
+import threading
+import time
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
+from .events import Event, LoggingSink
+from .incremental import WalkCache
+from .graph import EdgeIndex, make_square, write_dot, write_graphml, write_json, Z
+from .routes import Node, RouteTrie
+from .shards import shard_of
+from .resources import ResourcePool
+from .sinks import RouteSink, decode_value, dump_route, load_route, open_sink
 
-__all__ = ['Flow', 'Step', 'FlowFinished', 'FlowError']
 
+__all__ = ['Flow', 'AsyncFlow', 'Step', 'Budget', 'FlowFinished', 'FlowError',
+           'StepTimeout', 'ReplayResult']
 
-Node = namedtuple('Node', ('case', 'step'))
 
+logger = logging.getLogger(__name__)
 
-def setup_logger():
-    logger = logging.getLogger(__name__)
-    handler = logging.StreamHandler()
-    logger.addHandler(handler)
-    logger.setLevel(logging.INFO)
-    logger.propagate = False
-    return logger
-logger = setup_logger()
+# default ``events`` of a flow: they are logged
+_LOG_EVENTS = object()
+
+
+ReplayResult = namedtuple('ReplayResult',
+                          ('route_id', 'passed', 'depth', 'expected', 'actual'))
+ReplayResult.__doc__ = """Outcome of the replay of a recorded route
+
+``expected`` and ``actual`` are the names of the steps (or outcomes) the
+cases led to; ``depth`` is the first case where they differ, if any.
+"""
 
 
 class FlowFinished(Exception):
@@ -35,10 +53,29 @@ class FlowError(Exception):
     """
 
 
+class StepTimeout(FlowError):
+    """Indicate a step ran longer than its timeout: the route ends on it
+    """
+
+
 class Step(object):
     """Step Base Class
+
+    A step may define ``run_batch(list_of_params)``: the walker then runs
+    all the sibling cases of the step in one call. It returns the outcome
+    of each case, a step or an exception instance, and the steps must stay
+    valid while the routes after the others are walked.
+
+    ``setup`` and ``teardown`` are called around every run (replays too),
+    with the ``ResourcePool`` of the flow: resources borrowed in ``setup``
+    are better kept in ``_`` attributes and given back in ``teardown``.
+
+    ``timeout`` (seconds) overrides the ``step_timeout`` of the walk.
     """
     name = 'Step'
+    loop_limit = None
+    run_batch = None
+    timeout = None
 
     def __init__(self, **kwargs):
         for name, value in kwargs.items():
@@ -51,6 +88,36 @@ class Step(object):
     def run(self, params):
         raise NotImplementedError
 
+    def state_key(self):
+        """Return a hashable key of the state of this step
+
+        Steps with equal keys are expected to lead to the same subtree.
+        Defaults to the class and the public attributes.
+        """
+        attrs = sorted((name, repr(value)) for name, value in vars(self).items()
+                       if not name.startswith('_'))
+        cls = self.__class__
+        return ('{}.{}'.format(cls.__module__, cls.__name__), tuple(attrs))
+
+    def setup(self, resources):
+        """Called before ``run``
+        """
+
+    def teardown(self, resources):
+        """Called after ``run``, even if it raised
+        """
+
+    def snapshot(self):
+        """Return the state this step can be restored to before running
+        another case, or ``None`` if the route has to be replayed instead
+        """
+        return None
+
+    def restore(self, state):
+        """Go back to ``state`` returned by ``snapshot``
+        """
+        raise NotImplementedError
+
     def __str__(self):
         return self.name
 
@@ -58,124 +125,1133 @@ class Step(object):
         return '<{} "{}">'.format(self.__class__.__name__, self)
 
 
+class Budget(object):
+    """Limits of a walk
+
+    The walk stops (and can be resumed) once it has run for ``seconds``,
+    called ``Step.run`` ``runs`` times, found ``routes`` routes or reached
+    the ``coverage`` ratio of steps and edges (``Coverage.ratio``).
+    """
+    def __init__(self, seconds=None, runs=None, routes=None, coverage=None):
+        self.seconds = seconds
+        self.runs = runs
+        self.routes = routes
+        self.coverage = coverage
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+
+    def exhausted(self, flow):
+        """Return why ``flow`` should stop, or ``None``
+        """
+        if self.seconds is not None and time.time() - self.started >= self.seconds:
+            return 'time is up'
+        if self.runs is not None and flow.runs >= self.runs:
+            return '{} runs'.format(flow.runs)
+        if self.routes is not None and flow.route_count >= self.routes:
+            return '{} routes'.format(flow.route_count)
+        if (self.coverage is not None and flow.coverage.known
+                and flow.coverage.ratio >= self.coverage):
+            return '{:.0%} covered'.format(flow.coverage.ratio)
+        return None
+
+
+class Coverage(object):
+    """Steps, edges and transitions reached by a walk
+
+    A transition is a case of a step, ``(step, case label)``: all the
+    cases of a walked step are known, the ones that were run are covered.
+    Edges are ``(step, next step)`` as drawn by ``Flow.draw``.
+    """
+    def __init__(self):
+        self.steps = set()
+        self.edges = set()
+        self.known = set()
+        self.covered = set()
+        self.leads = {}
+        self._uncovered = defaultdict(int)
+
+    def know(self, step, cases):
+        name = str(step)
+        self.steps.add(name)
+        for case in cases:
+            transition = (name, case.label)
+            if transition not in self.known:
+                self.known.add(transition)
+                if transition not in self.covered:
+                    self._uncovered[name] += 1
+
+    def cover(self, step, case, end):
+        name = str(step)
+        transition = (name, case.label)
+        self.steps.add(name)
+        if transition not in self.covered:
+            self.covered.add(transition)
+            if transition in self.known:
+                self._uncovered[name] -= 1
+        self.edges.add((name, str(end)))
+        self.leads.setdefault(transition, set()).add(str(end))
+
+    def is_covered(self, step, case):
+        return (str(step), case.label) in self.covered
+
+    def is_spent(self, step, case):
+        """Whether running ``case`` of ``step`` again can't reach a new step
+        or edge: its transition is covered and the steps it led to have no
+        transition left to cover
+        """
+        transition = (str(step), case.label)
+        if transition not in self.covered:
+            return False
+        return not any(self._uncovered.get(end)
+                       for end in self.leads.get(transition, ()))
+
+    @property
+    def ratio(self):
+        """Steps and edges reached, over them and the transitions not
+        covered yet (each may still reach a new step or edge)
+        """
+        if not self.known:
+            return 0.0
+        reached = len(self.steps) + len(self.edges)
+        return reached / float(reached + sum(self._uncovered.values()))
+
+
+class Frame(object):
+    """A step on the walker stack, with the cases left to run
+
+    ``cost`` is the sum of the priorities of the cases that led to it.
+    ``outcomes`` holds the ``(case, outcome)`` left of a ``run_batch`` call.
+    """
+    def __init__(self, step, cases, state, cost=0):
+        self.step = step
+        self.cases = cases
+        self.state = state
+        self.cost = cost
+        self.need_trace = False
+        self.forced = False
+        self.outcomes = None
+
+
 class Flow(object):
     """Flow of steps
+
+    ``routes`` is a ``RouteTrie``: routes share their common prefix. Every
+    route is written to ``sink`` (a ``RouteSink`` or a file path) as soon
+    as it ends; without ``keep_routes`` it is not kept in ``routes``.
+
+    ``instrument`` (an ``aria.stats.Instrument``) is told about every run,
+    generated case, route and log line.
+
+    ``events`` (an ``aria.events.EventSink``) gets an ``Event`` for every
+    step entered, result, route and replay; they are logged by default.
+    Set it to ``None`` to switch them off; worker processes of parallel
+    walks log theirs unless they are switched off.
+
+    ``resources`` (an ``aria.resources.ResourcePool``) is lent to the steps
+    and closed at the end of the walk. Subclasses may override the walk
+    and route hooks: ``setup_walk``, ``teardown_walk``, ``setup_route``
+    (before the first run of a route, replays included) and
+    ``teardown_route`` (once it ended); the routes walked by worker
+    processes don't call them.
     """
-    def __init__(self, first_step):
+    def __init__(self, first_step, sink=None, keep_routes=True,
+                 instrument=None, events=_LOG_EVENTS, resources=None):
         self.step = first_step
-        self.routes = []
+        self.resources = resources if resources is not None else ResourcePool()
+        self._route_open = False
+        self.instrument = instrument
+        self.events = LoggingSink() if events is _LOG_EVENTS else events
+        self.routes = RouteTrie(first_step, keep=keep_routes)
+        self.edges = EdgeIndex()
+        self.route_count = 0
+        self.sink = open_sink(sink) if sink is not None else None
+        self.keep_routes = keep_routes
+        self._resume_path = None
+        self._pool = None
+        self._worker_resources = None
+        self._pending = []
+        self._running = []
+        self._split_depth = None
+        self._visited = None
+        self._max_depth = None
+        self._loop_limit = None
+        self._priority = 1
+        self._route = []
+        self._prefix = []
+        self._stack = []
+        self._loops = defaultdict(int)
+        self._paused = False
+        self._guided = False
+        self._seed = None
+        self._shard = None
+        self._shard_depth = 1
+        self._cache = None
+        self._cache_complete = True
+        self._step_timeout = None
+        self._route_timeout = None
+        self._route_started = None
+        self._deferred = deque()
+        self._base = 0
+        self.budget = None
+        self.coverage = Coverage()
+        self.runs = 0
 
-    def trace(self, route):
-        self.log(' {} '.format(len(self.routes) + 1).center(40, '='))
-        step = self.step
-        for case, _ in route:
-            self.log(step, case.label)
-            step = step.run(case.values)
+    def trace(self, route, checkpoints=()):
+        """Replay ``route`` and return the step it leads to
+
+        ``checkpoints`` holds ``(step, state)`` for each step of the route:
+        the replay starts from the last step with a saved state.
+        """
+        self.emit('replay_start', route=self.route_count + 1)
+        step, start, state = self.step, 0, None
+        for depth, (saved, saved_state) in enumerate(checkpoints[:len(route)]):
+            if saved_state is not None:
+                step, start, state = saved, depth, saved_state
+        if state is not None:
+            step.restore(state)
+        for case, _ in route[start:]:
+            self.emit('step_enter', step, case.label, replay=True)
+            step = self._run_step(step, case, replay=True)
         return step
 
-    def route_end(self, route):
-        self.routes.append(route)
+    def _run_step(self, step, case, replay=False):
+        self.runs += 1
+        timeout = self._timeout(step)
+        if self.instrument is None:
+            return run_step(step, case.values, self.resources, timeout)
+        started = time.perf_counter()
+        try:
+            return run_step(step, case.values, self.resources, timeout)
+        finally:
+            self.instrument.step_run(step, time.perf_counter() - started, replay)
 
-    def walk(self, step=None, route=None, priority=1):
-        step = step or self.step
-        route = route or []
-        need_trace = False
-        for case in step.form.iter_cases(priority):
-            route_priority = sum(node.case.priority for node in route)
-            if case.priority + route_priority > priority:
-                continue
-            if not self.routes and not route:
-                self.log(' 1 '.center(40, '='))
+    def route_end(self, leaf, record=None):
+        """Number the route ending with the ``leaf`` node of ``routes``
+
+        ``record`` is the record of a route reused from the cache.
+        """
+        if self._route_open:
+            self._route_open = False
+            self.teardown_route()
+        if self._pool is not None:
+            # numbered once the routes of the pool are merged
+            self._pending.append((leaf, record))
+        else:
+            self._record(leaf, record)
+
+    def _record(self, leaf, record=None):
+        self.route_count += 1
+        self.routes.end(leaf, self.route_count)
+        route = self.routes.path(leaf)
+        self.edges.add_route(self.route_count, self.step,
+                             [node.step for node in route])
+        if self.instrument is not None:
+            self.instrument.route_ended(self.route_count, len(route),
+                                        self.routes.size)
+        self.emit('route_end', route=self.route_count, depth=len(route))
+        if self.sink is None and self._cache is None:
+            return
+        if record is None:
+            record = dump_route(self.route_count, route)
+        else:
+            record = dict(record, id=self.route_count)
+        if self.sink is not None:
+            self.sink.write(record)
+        if self._cache is not None:
+            self._cache.add(record, self.step)
+
+    def _add(self, route, case, step):
+        return self.routes.add(route[-1] if route else None, case, step)
+
+    def walk(self, step=None, route=None, priority=1, workers=None,
+             split_depth=1, memoize=False, max_depth=None, loop_limit=None,
+             guided=False, budget=None, resume_from=None, seed=None,
+             shard=None, cache=None, step_timeout=None, route_timeout=None):
+        """Walk through every route from ``step``
+
+        With ``workers``, the subtrees below ``split_depth`` steps are
+        walked in a pool of processes; the routes are merged back in the
+        order a serial walk would have found them. The runs of a subtree
+        (and the counters of ``instrument``, see ``Instrument.fork``) are
+        added once it is done: a ``Budget`` only sees them then.
+
+        With ``memoize``, a step whose ``state_key`` was already reached is
+        not walked again: the route ends on it. It depends on the order of
+        the whole walk, so it can't be used with ``workers`` or ``shard``
+        (``ValueError``). Routes also end after
+        ``max_depth`` steps, or when a step class would be walked more than
+        ``loop_limit`` times (``Step.loop_limit`` overrides it per step).
+
+        With ``guided``, a case already run from a step of the same name is
+        put off until every route with new transitions was walked; it is
+        then replayed. The walk pauses once the ``Budget`` is exhausted.
+
+        ``resume_from`` is the sink (or path) of an interrupted walk: the
+        cases before its last route are skipped, the numbering goes on.
+
+        With ``seed``, the form of each step is reseeded from ``seed``, the
+        step class and the cases that led to it: the same seed gives the
+        same values, in any worker.
+
+        With ``shard=(k, n)``, only the routes of shard ``k`` out of ``n``
+        are walked: routes go to a shard by a stable hash of their first
+        ``split_depth`` cases. Every shard runs the steps before that depth.
+        ``aria.shards.merge_shards`` merges the sinks of the shards back
+        into the routes of a single walk (``seed`` defaults to ``0``, so
+        that every machine sees the same values).
+
+        ``cache`` is the path of a file keeping the routes of the last
+        complete walk, with a fingerprint of each step class (its code and
+        its form). The subtrees whose steps did not change since are not
+        walked again, their routes are taken from the cache.
+
+        A run longer than ``step_timeout`` seconds (or ``Step.timeout``),
+        or going past ``route_timeout`` seconds since the first run of its
+        route, ends the route on a ``StepTimeout``; the walk goes on with
+        the next case. Timed runs are made in a watchdog thread, which is
+        left behind if the step hangs: the step may then be in any state.
+        Replays are timed too: a route whose replay times out ends on the
+        case it was replayed for.
+        """
+        if memoize and (workers or shard is not None):
+            raise ValueError('memoize needs a single serial walk: it can not '
+                             'be used with workers or shard')
+        if shard is not None and seed is None:
+            seed = 0
+        self._setup(memoize, max_depth, loop_limit, guided, budget, seed,
+                    shard, split_depth, step_timeout, route_timeout)
+        self._cache = None
+        if cache is not None:
+            self._cache = WalkCache(cache, self.step, priority, self._options())
+            # a resumed or sharded walk only has a part of the routes
+            self._cache_complete = resume_from is None and shard is None
+        if resume_from is not None:
+            last = None
+            walked = open_sink(resume_from)
+            try:
+                for last in walked.records():
+                    self.edges.add_route(last['id'], self.step,
+                                         [node['step'] for node in last['nodes']])
+            finally:
+                if walked is not resume_from:
+                    walked.close()
+            if last is not None:
+                self._resume_path = last['path']
+                self.route_count = last['id']
+        try:
+            self.setup_walk()
+            if workers:
+                self._walk_parallel(priority, workers, split_depth)
+            else:
+                nodes = []
+                for case, node_step in route or []:
+                    nodes.append(self._add(nodes, case, node_step))
+                # no saved state: the route is replayed from the first step
+                steps = [self.step] + [node.step for node in nodes]
+                self._walk(step or self.step, nodes, priority,
+                           [(saved, None) for saved in steps[:len(nodes)]])
+            self._save_cache()
+        finally:
+            self._close()
+
+    @property
+    def paused(self):
+        return bool(self._stack)
+
+    def pause(self):
+        """Stop the walk before its next case
+
+        Can be called from ``Step.run`` or another thread; ``resume`` goes
+        on from where the walk stopped.
+        """
+        self._paused = True
+
+    def resume(self, budget=None):
+        self._paused = False
+        if budget is not None:
+            self.budget = budget
+            budget.start()
+        try:
+            self.setup_walk()
+            self._run_stack()
+            self._save_cache()
+        finally:
+            self._close()
+
+    def _save_cache(self):
+        if (self._cache is not None and self._cache_complete
+                and not self.paused):
+            self._cache.save()
+
+    def _close(self):
+        try:
+            if self._route_open:
+                self._route_open = False
+                self.teardown_route()
+            self.teardown_walk()
+        finally:
+            self.resources.close()
+            if self.sink is not None:
+                self.sink.close()
+            if self.events is not None:
+                self.events.flush()
+
+    def setup_walk(self):
+        """Called when a walk starts or resumes
+        """
+
+    def teardown_walk(self):
+        """Called when a walk ends or pauses
+        """
+
+    def setup_route(self):
+        """Called before the first run of each route
+        """
+
+    def teardown_route(self):
+        """Called once a route ended
+        """
+
+    def _open_route(self):
+        if not self._route_open:
+            self._route_open = True
+            self._route_started = time.monotonic()
+            self.setup_route()
+
+    def _timeout(self, step):
+        """Return how long the next run of ``step`` may take, ``None`` if
+        it is not timed
+        """
+        return run_timeout(step, self._step_timeout, self._route_timeout,
+                           self._route_started)
+
+    def _setup(self, memoize=False, max_depth=None, loop_limit=None,
+               guided=False, budget=None, seed=None, shard=None,
+               shard_depth=1, step_timeout=None, route_timeout=None):
+        self._step_timeout = step_timeout
+        self._route_timeout = route_timeout
+        self._visited = set() if memoize else None
+        self._seed = seed
+        self._shard = shard
+        self._shard_depth = max(1, shard_depth)
+        self._max_depth = max_depth
+        self._loop_limit = loop_limit
+        self._guided = guided
+        self._paused = False
+        self.budget = budget
+        if budget is not None:
+            budget.start()
+
+    def _options(self):
+        return dict(memoize=self._visited is not None,
+                    max_depth=self._max_depth, loop_limit=self._loop_limit,
+                    guided=self._guided, seed=self._seed, shard=self._shard,
+                    shard_depth=self._shard_depth,
+                    step_timeout=self._step_timeout,
+                    route_timeout=self._route_timeout)
+
+    def _owns(self, route, case, ended):
+        """Whether the route going through ``case`` after ``route`` belongs
+        to the shard of this walk
+        """
+        depth = len(route) + 1
+        if (self._shard is None or depth > self._shard_depth
+                or (depth < self._shard_depth and not ended)):
+            return True
+        shard, count = self._shard
+        path = [node.case.index for node in route] + [case.index]
+        return shard_of(path, count) == shard
+
+    def _case_seed(self, step, route):
+        """Return the seed of the form of ``step``, reached by ``route``
+
+        Forms regenerated once per run get the same seed at every visit.
+        """
+        if self._seed is None:
+            return None
+        cls = step.__class__
+        path = ([node.case.index for node in route]
+                if getattr(step.form, 'regenerate', None) != 'run' else '')
+        return '{}/{}.{}/{}'.format(self._seed, cls.__module__, cls.__name__,
+                                    path)
+
+    def _walk(self, step, route, priority, checkpoints):
+        """Walk from ``step``, reached by ``route``
+
+        ``checkpoints`` holds ``(step, state)`` for each step of the route.
+        """
+        self._priority = priority
+        self._route = route
+        self._prefix = checkpoints
+        self._stack = []
+        self._deferred = deque()
+        self._base = len(route)
+        self._loops = defaultdict(int)
+        for saved, _ in checkpoints:
+            self._loops[saved.__class__] += 1
+        if self._cache is not None and self._reuse(route, step):
+            if not self._base:
+                self.emit('walk_end')
+            return
+        self._push(step, sum(node.case.priority for node in route))
+        self._run_stack()
+
+    def _resume_deferred(self, route, case, checkpoints, step, state):
+        """Walk ``case`` of ``step``, reached by ``route``, put off by
+        ``guided``; ``checkpoints`` and ``state`` are the ones it had then
+        """
+        self._route = route
+        self._prefix = checkpoints
+        self._loops = defaultdict(int)
+        for saved in [self.step] + [node.step for node in route]:
+            self._loops[saved.__class__] += 1
+        frame = Frame(step, iter([case]), state,
+                      sum(node.case.priority for node in route))
+        frame.need_trace = frame.forced = True
+        self._stack = [frame]
+
+    def _push(self, step, cost):
+        """Put ``step`` on the stack, with the cases it can still afford
+        """
+        if self._visited is not None:
+            self._visited.add(step.state_key())
+        self._loops[step.__class__] += 1
+        instrument = self.instrument
+        cases = step.form.iter_cases(
+            self._priority, seed=self._case_seed(step, self._route),
+            max_priority=self._priority - cost,
+            pruned=instrument.pruned if instrument is not None else None)
+        if self._guided or (self.budget and self.budget.coverage is not None):
+            cases = list(cases)
+            self.coverage.know(step, cases)
+            cases = iter(cases)
+        self._stack.append(Frame(step, cases, step.snapshot(), cost))
+
+    def _pop(self):
+        frame = self._stack.pop()
+        self._loops[frame.step.__class__] -= 1
+        if self._stack:
+            self._route.pop()
+
+    def _run_stack(self):
+        while self._run_frames():
+            if not self._deferred:
+                break
+            self._resume_deferred(*self._deferred.popleft())
+        else:
+            return
+        if not self._base:
+            self.emit('walk_end')
+
+    def _run_frames(self):
+        """Run the cases of the stack, return ``False`` if the walk stopped
+        before the stack was empty
+        """
+        route, priority = self._route, self._priority
+        while self._stack:
+            if self._paused and self._pool is None:
+                return False
+            reason = self.budget and self.budget.exhausted(self)
+            if reason:
+                self.emit('walk_pause', label=reason)
+                self._paused = True
+                return False
+            frame = self._stack[-1]
+            if frame.outcomes is not None:
+                case, outcome = next(frame.outcomes, (None, None))
+                if case is None:
+                    self._pop()
+                    continue
+                step = frame.step
+                self._open_route()
+            else:
+                if self.instrument is not None:
+                    started = time.perf_counter()
+                case = next(frame.cases, None)
+                if case is None:
+                    self._pop()
+                    continue
+                if self.instrument is not None:
+                    self.instrument.case_generated(
+                        time.perf_counter() - started)
+                if not self._accept(frame, route, case):
+                    continue
+                if not self.route_count and not route:
+                    self.emit('route_start', route=1)
+                self._open_route()
+                try:
+                    step = self._prepare(frame)
+                except StepTimeout as e:
+                    # the replay of the route hung: the case can't be run
+                    self.emit('step_result', e, case.label)
+                    if self._owns(route, case, True):
+                        self.route_end(self._add(route, case, e))
+                    continue
+                frame.need_trace = True
+                if getattr(step, 'run_batch', None) is not None:
+                    self._run_batch(frame, route, case)
+                    continue
             label = case.label
-            if need_trace:
-                step = self.trace(route)
-            self.log(step, label)
+            self.emit('step_enter', step, label)
             try:
-                new_step = step.run(case.values)
-            except FlowFinished as e:
-                self.log(e)
-                self.route_end(route + [Node(case, e)])
-            except FlowError as e:
-                self.log(e)
-                self.route_end(route + [Node(case, e)])
+                if frame.outcomes is None:
+                    new_step = self._run_step(step, case)
+                elif isinstance(outcome, BaseException):
+                    raise outcome
+                else:
+                    new_step = outcome
+            except (FlowFinished, FlowError) as e:
+                self.emit('step_result', e, label)
+                self.coverage.cover(step, case, e)
+                if self._owns(route, case, True):
+                    self.route_end(self._add(route, case, e))
             except Exception as e:
-                logger.exception('Something goes wrong with %s(%s)',
-                                                          step, label)
-                self.route_end(route + [Node(case, e.__class__.__name__)])
+                self.emit('step_error', step, label, exc_info=sys.exc_info())
+                self.coverage.cover(step, case, e.__class__.__name__)
+                if self._owns(route, case, True):
+                    self.route_end(self._add(route, case, e.__class__.__name__))
             else:
-                route.append(Node(case, new_step))
-                self.walk(new_step, route, priority)
-            need_trace = True
+                self.emit('step_result', new_step, label)
+                self.coverage.cover(step, case, new_step)
+                reason = self._stop_reason(new_step, len(route) + 1)
+                if not self._owns(route, case, bool(reason)):
+                    # walked by another shard
+                    continue
+                route.append(self._add(route, case, new_step))
+                if reason:
+                    self.emit('route_stop', new_step, reason)
+                    self.route_end(route[-1])
+                    route.pop()
+                elif self._cache is not None and self._reuse(route, new_step):
+                    route.pop()
+                elif self._pool is not None and len(route) >= self._split_depth:
+                    self._split(route, priority)
+                    route.pop()
+                else:
+                    self._push(new_step, frame.cost + case.priority)
+        return True
+
+    def _accept(self, frame, route, case):
+        """Whether ``case`` of ``frame`` is to be run now
+        """
+        if self._resume_path is not None and self._walked(route, case):
+            return False
+        if (self._shard is not None and len(route) + 1 == self._shard_depth
+                and not self._owns(route, case, True)):
+            # walked by another shard: known before it runs
+            return False
+        if (self._guided and not frame.forced
+                and self.coverage.is_spent(frame.step, case)):
+            # kept with the states to go back to, not replayed from the start
+            checkpoints = self._prefix + [(f.step, f.state) for f in self._stack]
+            self._deferred.append((list(route), case, checkpoints[:len(route)],
+                                   frame.step, frame.state))
+            return False
+        return True
+
+    def _run_batch(self, frame, route, first):
+        """Run ``first`` and the other cases left in ``frame`` with a single
+        ``Step.run_batch`` call; their outcomes are walked one by one
+        """
+        cases = [first] + [case for case in frame.cases
+                           if case.priority + frame.cost <= self._priority
+                           and self._accept(frame, route, case)]
+        step = frame.step
+        self.runs += len(cases)
+        started = time.perf_counter() if self.instrument is not None else None
+        try:
+            outcomes = list(run_step(step, [case.values for case in cases],
+                                     self.resources, self._timeout(step),
+                                     step.run_batch))
+            if len(outcomes) != len(cases):
+                raise FlowError('{} returned {} outcomes for {} cases'.format(
+                    step, len(outcomes), len(cases)))
+        except Exception as e:
+            outcomes = [e] * len(cases)
+        if started is not None:
+            seconds = (time.perf_counter() - started) / len(cases)
+            for _ in cases:
+                self.instrument.step_run(step, seconds, False)
+        frame.outcomes = iter(list(zip(cases, outcomes)))
+
+    def _prepare(self, frame):
+        """Bring the step of ``frame`` back to the state of its first case
+        """
+        if not frame.need_trace:
+            return frame.step
+        if frame.state is not None:
+            self.emit('replay_start', route=self.route_count + 1,
+                      restored=True)
+            frame.step.restore(frame.state)
+        else:
+            checkpoints = self._prefix + [(f.step, f.state) for f in self._stack]
+            frame.step = self.trace(self._route, checkpoints)
+        return frame.step
+
+    def _reuse(self, route, step):
+        """End the routes after ``route`` with the ones of the cache, if
+        ``step`` and the steps after it did not change
+        """
+        records = self._cache.reusable([node.case.index for node in route], step)
+        if records is None:
+            return False
+        for record in records:
+            nodes = load_route(record)
+            self.route_end(self.routes.graft(list(route) + nodes[len(route):]),
+                           record)
+        return True
+
+    def _walked(self, route, case):
+        """Whether ``case`` was walked before the walk was resumed
+
+        Walks go through the cases in index order: everything before the
+        path of the last route written is done.
+        """
+        path = [node.case.index for node in route] + [case.index]
+        last = self._resume_path
+        if path < last[:len(path)] or path == last:
+            return True
+        if path > last[:len(path)]:
+            self._resume_path = None
+        return False
+
+    def _stop_reason(self, step, depth):
+        """Return why the route should end on ``step``, reached after
+        ``depth`` cases, instead of walking it
+        """
+        if self._visited is not None and step.state_key() in self._visited:
+            return 'visited'
+        if self._max_depth is not None and depth >= self._max_depth:
+            return 'max depth'
+        limit = getattr(step, 'loop_limit', None) or self._loop_limit
+        if limit is not None and self._loops[step.__class__] >= limit:
+            return 'loop limit'
+        return None
+
+    def _walk_parallel(self, priority, workers, split_depth):
+        self._worker_resources = self.resources.for_workers()
+        with ProcessPoolExecutor(workers) as pool:
+            self._pool, self._split_depth = pool, max(1, split_depth)
+            try:
+                self._walk(self.step, [], priority, [])
+            finally:
+                self._pool = None
+            pending, self._pending = self._pending, []
+            self._merge_counters(wait=True)
+            for leaf in pending:
+                if isinstance(leaf, Future):
+                    for route in leaf.result()[0]:
+                        self._record(self.routes.graft(route))
+                else:
+                    self._record(*leaf)
+
+    def _merge_counters(self, wait=False):
+        """Add the runs and the instrument of the subtrees walked by the
+        workers (the ones done so far, or all of them with ``wait``)
+        """
+        running = []
+        for future in self._running:
+            if not wait and not future.done():
+                running.append(future)
+                continue
+            _, runs, instrument = future.result()
+            self.runs += runs
+            if instrument is not None:
+                self.instrument.merge(instrument)
+        self._running = running
+
+    def replay(self, routes, workers=None, chunksize=16, step_timeout=None,
+               route_timeout=None):
+        """Run the recorded ``routes`` (a sink, a path or records) again and
+        return a ``ReplayResult`` per route
+
+        Each route is replayed from a copy of the first step, with the
+        values it was recorded with; it diverges when a case leads to
+        another step or outcome than recorded. With ``workers``, routes are
+        replayed in a pool of processes. No case is generated.
+
+        ``step_timeout`` and ``route_timeout`` are the ones of ``walk``: a
+        route timing out diverges on a ``StepTimeout``.
+        """
+        if isinstance(routes, str):
+            sink = open_sink(routes)
+            try:
+                records = list(sink.records())
+            finally:
+                sink.close()
+        elif isinstance(routes, RouteSink):
+            records = list(routes.records())
+        else:
+            records = list(routes)
         try:
-            route.pop()
-        except IndexError:
-            self.log(' THE END '.center(40, '='))
+            if workers:
+                with ProcessPoolExecutor(workers) as pool:
+                    results = list(pool.map(
+                        replay_route, [self.step] * len(records), records,
+                        [self.resources.for_workers()] * len(records),
+                        [step_timeout] * len(records),
+                        [route_timeout] * len(records),
+                        chunksize=chunksize))
+            else:
+                results = [replay_route(self.step, record, self.resources,
+                                        step_timeout, route_timeout)
+                           for record in records]
+        finally:
+            self.resources.close()
+        for result in results:
+            self.runs += len(result.actual)
+            self.emit('route_replayed', label=result.route_id, result=result)
+        return results
+
+    def load(self, records):
+        """Add the routes of ``records``, as written to a sink, in order
+
+        Their cases are ``RecordedCase`` and their steps are names: enough
+        to export or draw the routes of another walk.
+        """
+        for record in records:
+            self._record(self.routes.graft(load_route(record)))
 
-    def log(self, step, label=None, *args, **kwargs):
-        msg = str(step)
-        if label:
-            msg += ' ({})'.format(label)
-        logger.info(msg, *args, **kwargs)
+    def _split(self, route, priority):
+        """Hand the subtree after ``route`` to the pool
+
+        Its routes are kept in place by a ``Future`` until the walk ends;
+        its runs are counted once it is done.
+        """
+        self._merge_counters()
+        prefix = [node.case.index for node in route]
+        # the subtree of the last route of a resumed walk goes on after it
+        resume_path = self._resume_path
+        if resume_path is not None and resume_path[:len(prefix)] != prefix:
+            resume_path = None
+        future = self._pool.submit(
+            walk_subtree, self.step, prefix, priority, self._options(),
+            self._worker_resources,
+            self.events is not None and self.events.enabled, resume_path,
+            self.instrument.fork() if self.instrument is not None else None)
+        self._pending.append(future)
+        self._running.append(future)
+
+    def emit(self, kind, step=None, label=None, **data):
+        """Hand an ``Event`` to ``events``
+        """
+        events = self.events
+        if events is None or not events.enabled:
+            return
+        if self.instrument is not None:
+            started = time.perf_counter()
+        events.emit(Event(kind, step, label, **data))
+        if self.instrument is not None:
+            self.instrument.logged(time.perf_counter() - started)
+
+    def log(self, step, label=None):
+        self.emit('log', step, label)
 
     def _merge_routes(self):
         """
-        route = [(case, step), ... , (case, FlowError)]
-        routes = [route, ... , route]
-        graph = [(start_step, end_step, label), ...]
-        """
-        groups = defaultdict(set)
-        for idx, route in enumerate(self.routes, start=1):
-            start = self.step
-            for node in route:
-                end = node.step
-                edge = '"{}" -> "{}"'.format(Z(start), Z(end))
-                groups[edge].add(idx)
-                start = end
-        graph = ['{} [ label = "{}" ]'.format(edge, make_square(idx_list))
-                 for edge, idx_list in groups.items()]
-        return graph
-
-    def draw(self, graphviz, img_path):
-        edges = self._merge_routes()
+        graph = ['"start" -> "end" [ label = "(route ids)" ]', ...]
+        """
+        return ['"{}" -> "{}" [ label = "{}" ]'.format(
+                    Z(start), Z(end), make_square(route_ids))
+                for start, end, route_ids in self.edges]
+
+    def export(self, path):
+        """Write the edges to ``path``: JSON for ``.json``, GraphML for
+        ``.graphml``, DOT otherwise
+        """
+        writer = {'.json': write_json, '.graphml': write_graphml}.get(
+            os.path.splitext(path)[1], write_dot)
+        with io.open(path, 'w', encoding='utf-8') as stream:
+            writer(self.edges, stream)
+
+    def draw(self, graphviz, img_path, split=False, workers=None):
+        """Draw the routes with GraphViz
+
+        With ``split``, each start step gets its own image, named after
+        ``img_path`` and the step, and ``workers`` images are rendered at
+        the same time.
+        """
         img_dir = os.path.dirname(os.path.realpath(img_path))
         try:
             os.makedirs(img_dir)
         except (IOError, OSError):
             """dir already exists"""
-        gv_path = os.path.splitext(img_path)[0] + '.gv'
-        font = 'Microsoft Yahei'
-        with open(gv_path, 'w', encoding='utf-8') as gv:
-            gv.write('digraph {\n')
-            gv.write('node [shape="box"];\n')
-            gv.write('edge [fontsize="12" fontcolor="blue"];\n')
-            gv.writelines(edges)
-            gv.write('}')
-        _, img_type = os.path.splitext(img_path)
+        base, img_type = os.path.splitext(img_path)
+        if split:
+            jobs = [('{}-{}{}'.format(base, file_name(start), img_type), edges)
+                    for start, edges in self.edges.by_start().items()]
+        else:
+            jobs = [(img_path, self.edges)]
+        for path, edges in jobs:
+            with io.open(os.path.splitext(path)[0] + '.gv', 'w',
+                         encoding='utf-8') as gv:
+                write_dot(edges, gv)
+        with ThreadPoolExecutor(workers or 1) as pool:
+            list(pool.map(lambda path: render(graphviz, path),
+                          [path for path, _ in jobs]))
+
+class AsyncFlow(Flow):
+    """Flow of steps whose ``run`` may be a coroutine
+
+    Sibling cases are walked concurrently, each on its own replay of the
+    route, with at most ``concurrency`` ``run`` calls at the same time.
+    Steps are always replayed: snapshots can't be shared between branches.
+    Routes are recorded (and written to the sink) as soon as every route
+    a serial walk would find before them has ended.
+    """
+    def __init__(self, first_step, concurrency=10, sink=None, keep_routes=True,
+                 instrument=None, events=_LOG_EVENTS, resources=None):
+        super(AsyncFlow, self).__init__(first_step, sink, keep_routes,
+                                        instrument, events, resources)
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._open = set()
+        self._ended = []
+
+    async def walk(self, step=None, priority=1, seed=None, step_timeout=None):
+        """Walk through every route from ``step``
+
+        Awaited runs longer than ``step_timeout`` (or ``Step.timeout``)
+        seconds end their route on a ``StepTimeout``.
+        """
+        self._seed = seed
+        self._step_timeout = step_timeout
+        self._semaphore = asyncio.Semaphore(self.concurrency)
         try:
-            subprocess.call([graphviz, '-T{}'.format(img_type[1:]),
-                '-Efontname={}'.format(font),
-                '-Nfontname={}'.format(font),
-                '-o' + img_path, gv_path
-            ])
-        except (IOError, OSError):
-            logger.error('GraphViz cannot be started: %s', graphviz)
-
-def make_square(items):
-    stream = StringIO()
-    text = ''.join('({})'.format(item) for item in items)
-    width = max(int(math.sqrt(len(text) * 2 / 0.618)), 12)
-    pos = 0
-    for item in items:
-        chunk = '({})'.format(item)
-        if pos + len(chunk) > width:
-            stream.write('\n')
-            pos = 0
-        offset = stream.write(chunk)
-        pos += offset
-    return stream.getvalue()
-
-def Z(text):
-    if not text:
-        return text
-    text = str(text)
-    return '\n'.join(text.split()).replace('\\', '\\\\')
+            self.setup_walk()
+            self._open, self._ended = set(), []
+            await self._walk(step or self.step, [], (), priority)
+            self._flush()
+            self.emit('walk_end')
+        finally:
+            self._close()
+
+    async def trace(self, route, checkpoints=()):
+        step = self.step
+        for case, _ in route:
+            self.emit('step_enter', step, case.label, replay=True)
+            step = await self._run(step, case)
+        return step
+
+    def _end(self, path, route):
+        """Record the routes that ended, up to the first one a branch still
+        walked may come before
+        """
+        self._open.discard(path)
+        heapq.heappush(self._ended, (path, len(self._ended), route))
+        self._flush()
+
+    def _flush(self):
+        while self._ended and (not self._open
+                               or self._ended[0][0] < min(self._open)):
+            self._record(self.routes.graft(heapq.heappop(self._ended)[2]))
+
+    async def _walk(self, step, route, path, priority):
+        route_priority = sum(node.case.priority for node in route)
+        instrument = self.instrument
+        cases = list(step.form.iter_cases(
+            priority, seed=self._case_seed(step, route),
+            max_priority=priority - route_priority,
+            pruned=instrument.pruned if instrument is not None else None))
+        # the branches are open until their route ended or they branched
+        self._open.update(path + (n,) for n in range(len(cases)))
+        self._open.discard(path)
+        await asyncio.gather(*(
+            self._branch(step if n == 0 else None, route, path + (n,),
+                         case, priority)
+            for n, case in enumerate(cases)))
+
+    async def _branch(self, step, route, path, case, priority):
+        if step is None:
+            try:
+                step = await self.trace(route)
+            except StepTimeout as e:
+                # the replay of the route hung: the case can't be run
+                self.emit('step_result', e, case.label)
+                self._end(path, route + [Node(case, e)])
+                return
+        self.emit('step_enter', step, case.label)
+        try:
+            new_step = await self._run(step, case)
+        except (FlowFinished, FlowError) as e:
+            self.emit('step_result', e, case.label)
+            self._end(path, route + [Node(case, e)])
+        except Exception as e:
+            self.emit('step_error', step, case.label, exc_info=sys.exc_info())
+            self._end(path, route + [Node(case, e.__class__.__name__)])
+        else:
+            self.emit('step_result', new_step, case.label)
+            await self._walk(new_step, route + [Node(case, new_step)], path,
+                             priority)
+
+    async def _run(self, step, case):
+        async with self._semaphore:
+            self.runs += 1
+            started = time.perf_counter()
+            step.setup(self.resources)
+            try:
+                result = step.run(case.values)
+                if inspect.isawaitable(result):
+                    result = await self._watch(step, result)
+                return result
+            finally:
+                step.teardown(self.resources)
+                if self.instrument is not None:
+                    self.instrument.step_run(
+                        step, time.perf_counter() - started, False)
+
+    async def _watch(self, step, awaitable):
+        timeout = getattr(step, 'timeout', None) or self._step_timeout
+        if timeout is None:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            raise StepTimeout('{} timed out'.format(step))
+
+
+def walk_subtree(first_step, prefix, priority, options=None, resources=None,
+                 log_events=True, resume_path=None, instrument=None):
+    """Walk the subtree after ``prefix`` and return its routes, the number
+    of runs and ``instrument``
+
+    ``prefix`` is the index of the case run at each step from ``first_step``.
+    Run in the worker processes of ``Flow.walk``, where the resources of
+    ``resources`` are created once per process. ``resume_path`` is the
+    path of the last route walked before a resumed walk, if in the subtree.
+    """
+    flow = Flow(first_step, resources=resources and resources.for_process(),
+                events=_LOG_EVENTS if log_events else None,
+                instrument=instrument)
+    flow._setup(**(options or {}))
+    flow._resume_path = resume_path
+    flow.emit('replay_start', route=prefix)
+    flow._open_route()
+    step, route, checkpoints = first_step, [], []
+    for index in prefix:
+        checkpoints.append((step, step.snapshot()))
+        case = step.form.case_at(index, priority,
+                                 seed=flow._case_seed(step, route))
+        flow.emit('step_enter', step, case.label, replay=True)
+        try:
+            new_step = flow._run_step(step, case, replay=True)
+        except StepTimeout as e:
+            flow.emit('step_result', e, case.label)
+            flow.route_end(flow._add(route, case, e))
+            return ([[Node(case, step) for case, step in route]
+                     for route in flow.routes], flow.runs, instrument)
+        route.append(flow._add(route, case, new_step))
+        step = new_step
+    flow._walk(step, route, priority, checkpoints)
+    return ([[Node(case, step) for case, step in route] for route in flow.routes],
+            flow.runs, instrument)
+
+
+def run_step(step, params, resources, timeout=None, run=None):
+    """Run ``step`` with ``params`` between its ``setup`` and ``teardown``
+
+    With ``timeout``, the run is made in a watchdog thread and raises
+    ``StepTimeout`` if it did not return in time. ``run`` defaults to
+    ``step.run``.
+    """
+    run = run or step.run
+    if timeout is not None:
+        return watch(step, run_step, (step, params, resources, None, run),
+                     timeout)
+    step.setup(resources)
+    try:
+        return run(params)
+    finally:
+        step.teardown(resources)
+
+
+def run_timeout(step, step_timeout, route_timeout, route_started):
+    """Return how long the next run of ``step`` may take, ``None`` if it
+    is not timed; the route started at ``route_started`` (``time.monotonic``)
+    """
+    timeout = getattr(step, 'timeout', None) or step_timeout
+    if route_timeout is not None and route_started is not None:
+        left = route_timeout - (time.monotonic() - route_started)
+        timeout = left if timeout is None else min(timeout, left)
+    return timeout
+
+
+def watch(step, func, args, timeout):
+    """Call ``func(*args)`` in a daemon thread, raise ``StepTimeout`` if it
+    did not return within ``timeout`` seconds
+    """
+    if timeout <= 0:
+        raise StepTimeout('{} timed out'.format(step))
+    result = []
+    done = threading.Event()
+
+    def target():
+        try:
+            result.append((True, func(*args)))
+        except BaseException as e:
+            result.append((False, e))
+        finally:
+            done.set()
+
+    threading.Thread(target=target, name='aria-step', daemon=True).start()
+    if not done.wait(timeout):
+        raise StepTimeout('{} timed out'.format(step))
+    returned, value = result[0]
+    if not returned:
+        raise value
+    return value
+
+
+def replay_route(first_step, record, resources=None, step_timeout=None,
+                 route_timeout=None):
+    """Replay the route of ``record`` from a copy of ``first_step``
+
+    Run in the worker processes of ``Flow.replay``.
+    """
+    resources = resources.for_process() if resources is not None else ResourcePool()
+    step = copy.deepcopy(first_step)
+    expected = [node['step'] for node in record['nodes']]
+    actual = []
+    started = time.monotonic()
+    for node in record['nodes']:
+        try:
+            timeout = run_timeout(step, step_timeout, route_timeout, started)
+            step = run_step(step, decode_value(node['values']), resources,
+                            timeout)
+        except (FlowFinished, FlowError) as e:
+            actual.append(str(e))
+            break
+        except Exception as e:
+            actual.append(e.__class__.__name__)
+            break
+        actual.append(str(step))
+        if actual[-1] != node['step']:
+            break
+    depth = next((depth for depth, (want, got)
+                  in enumerate(zip(expected, actual)) if want != got), None)
+    if depth is None and len(actual) != len(expected):
+        depth = len(actual)
+    return ReplayResult(record['id'], depth is None, depth, expected, actual)
+
+
+def render(graphviz, img_path):
+    """Render the ``.gv`` file next to ``img_path``
+    """
+    font = 'Microsoft Yahei'
+    gv_path = os.path.splitext(img_path)[0] + '.gv'
+    _, img_type = os.path.splitext(img_path)
+    try:
+        subprocess.call([graphviz, '-T{}'.format(img_type[1:]),
+            '-Efontname={}'.format(font),
+            '-Nfontname={}'.format(font),
+            '-o' + img_path, gv_path
+        ])
+    except (IOError, OSError):
+        logger.error('GraphViz cannot be started: %s', graphviz)
+
+
+def file_name(text):
+    return ''.join(char if char.isalnum() or char in '-_.' else '_'
+                   for char in str(text))
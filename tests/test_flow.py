@@ -1,10 +1,32 @@
 # coding: utf-8
 """Walk around the ``Step``s
 """
+import asyncio
+import json
+import logging
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from decimal import Decimal
 from uuid import uuid4
+from xml.etree import ElementTree
 
 from aria import Form, EnumField
-from aria.walker import Flow, Step, FlowFinished, FlowError
+from aria.events import NullSink, QueueSink, RingBufferSink
+from aria.shards import merge_shards
+from aria.resources import ResourcePool
+from aria.sinks import open_sink
+from aria.stats import WalkStats
+from aria.walker import Flow, AsyncFlow, Step, Budget, FlowFinished, FlowError
+from aria.walker import StepTimeout
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 class Service(object):
@@ -32,6 +54,18 @@ class Service(object):
         return cls.orders[order_id]
 
 
+class OrderStep(Step):
+    """可以回到之前状态的订单步骤
+    """
+    order_id = None
+
+    def snapshot(self):
+        return dict(Service.get_order(self.order_id))
+
+    def restore(self, state):
+        Service.update_order(self.order_id, state)
+
+
 class SubmitOrder(Step):
     """提交订单
     """
@@ -55,7 +89,7 @@ class SubmitOrder(Step):
             raise FlowError('未知错误')
 
 
-class OnlinePayment(Step):
+class OnlinePayment(OrderStep):
     """在线支付
     """
     name = '在线支付'
@@ -75,7 +109,7 @@ class OnlinePayment(Step):
             raise FlowError('订单取消')
 
 
-class PackageGift(Step):
+class PackageGift(OrderStep):
     """礼品包装
     """
     name = '礼品包装'
@@ -95,7 +129,7 @@ class PackageGift(Step):
             raise FlowError('未知错误')
 
 
-class DeliverGoods(Step):
+class DeliverGoods(OrderStep):
     """发货
     """
     name = '发货'
@@ -113,6 +147,600 @@ class DeliverGoods(Step):
             raise FlowError('用户拒收')
 
 
+class FlowTest(unittest.TestCase):
+    """Tests for walking the order flow
+    """
+    def setUp(self):
+        Service.orders = {}
+
+    def test_walk(self):
+        flow = Flow(SubmitOrder())
+        flow.walk(priority=3)
+        self.assertEqual(len(flow.routes), 25)
+        # routes share the nodes of their common prefix
+        self.assertIs(flow.routes[0][0], flow.routes[1][0])
+        # the steps after the first one are restored instead of replayed
+        self.assertEqual(len(Service.orders),
+                         SubmitOrder.form.count_cases(priority=3))
+
+    def test_parallel_walk(self):
+        serial = Flow(SubmitOrder())
+        serial.walk(priority=3)
+        parallel = Flow(SubmitOrder())
+        parallel.walk(priority=3, workers=2, split_depth=2)
+        self.assertEqual(route_labels(parallel), route_labels(serial))
+
+    def test_walk_from_route(self):
+        serial = Flow(SubmitOrder())
+        serial.walk(priority=3)
+        first = SubmitOrder()
+        case, = [case for case in first.form.iter_cases(3)
+                 if case.label == '普通包装 在线支付']
+        payment = first.run(case.values)
+        flow = Flow(first)
+        flow.walk(step=payment, route=[(case, payment)], priority=3)
+        self.assertEqual(route_labels(flow),
+                         [labels for labels in route_labels(serial)
+                          if labels[0][0] == case.label])
+
+        # 大厅 can be restored, 门 is replayed from the first step
+        serial = Flow(Gate())
+        serial.walk()
+        case = next(Gate().form.iter_cases())
+        hall = Gate().run(case.values)
+        flow = Flow(Gate())
+        flow.walk(step=hall, route=[(case, hall)])
+        self.assertEqual(route_labels(flow),
+                         [labels for labels in route_labels(serial)
+                          if labels[0][0] == case.label])
+
+    def test_memoized_walk(self):
+        flow = Flow(SubmitOrder())
+        flow.walk(priority=3, memoize=True)
+        looped = [route for route in flow.routes
+                  if isinstance(route[-1].step, PackageGift)]
+        self.assertTrue(looped)
+        self.assertLess(len(flow.routes), 25)
+
+        # both cases of 门 lead to the same 房间: walked once
+        serial = Flow(Door())
+        serial.walk(memoize=True)
+        self.assertEqual(route_labels(serial),
+                         [[('进门', '房间'), ('离开', '完成')],
+                          [('进门', '房间'), ('留下', '完成')],
+                          [('敲门', '房间')]])
+        with self.assertRaises(ValueError):
+            Flow(Door()).walk(memoize=True, workers=2)
+        with self.assertRaises(ValueError):
+            Flow(Door()).walk(memoize=True, shard=(0, 2))
+
+    def test_pause_and_resume(self):
+        serial = Flow(SubmitOrder())
+        serial.walk(priority=3)
+        flow = PausingFlow(SubmitOrder())
+        flow.walk(priority=3)
+        self.assertTrue(flow.paused)
+        self.assertEqual(len(flow.routes), 5)
+        flow.resume()
+        self.assertFalse(flow.paused)
+        self.assertEqual(route_labels(flow), route_labels(serial))
+
+    def test_deep_walk(self):
+        flow = Flow(Retry())
+        flow.walk(priority=0, max_depth=2000)
+        self.assertEqual(len(flow.routes), 1)
+        self.assertEqual(len(flow.routes[0]), 2000)
+        flow = Flow(Retry())
+        flow.walk(priority=1, loop_limit=3)
+        self.assertEqual(max(map(len, flow.routes)), 3)
+
+    def test_guided_walk(self):
+        full = Flow(SubmitOrder())
+        full.walk(priority=3)
+        guided = Flow(SubmitOrder())
+        guided.walk(priority=3, guided=True, budget=Budget(coverage=1.0))
+        self.assertTrue(guided.paused)
+        self.assertEqual(guided.coverage.covered, full.coverage.covered)
+        self.assertLess(guided.runs, full.runs)
+        self.assertEqual(guided.coverage.steps, full.coverage.steps)
+        guided.resume(Budget())
+        self.assertEqual(sorted(route_labels(guided)), sorted(route_labels(full)))
+        self.assertEqual(guided.coverage.edges, full.coverage.edges)
+        # cases put off go back to their checkpoints
+        self.assertEqual(guided.runs, full.runs)
+        unbudgeted = Flow(SubmitOrder())
+        unbudgeted.walk(priority=3, guided=True)
+        self.assertEqual(unbudgeted.runs, full.runs)
+
+    def test_resume_walk(self):
+        serial = Flow(SubmitOrder())
+        serial.walk(priority=3)
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        for name in ['routes.jsonl', 'routes.db']:
+            path = os.path.join(output_dir, name)
+            interrupted = Flow(SubmitOrder(), sink=path)
+            interrupted.walk(priority=3, budget=Budget(routes=7))
+            resumed = Flow(SubmitOrder(), sink=path, keep_routes=False)
+            resumed.walk(priority=3, resume_from=path)
+            self.assertEqual(len(resumed.routes), 0)
+            records = list(open_sink(path).records())
+            self.assertEqual([record['id'] for record in records],
+                             list(range(1, 26)))
+            self.assertEqual(
+                [[(node['label'], node['step']) for node in record['nodes']]
+                 for record in records],
+                route_labels(serial))
+
+        # the walk crashed while writing route 8
+        path = os.path.join(output_dir, 'cut.jsonl')
+        Flow(SubmitOrder(), sink=path).walk(priority=3, budget=Budget(routes=8))
+        with open(path, 'rb') as f:
+            lines = f.readlines()
+        with open(path, 'wb') as f:
+            f.writelines(lines[:7] + [lines[7][:20]])
+        Flow(SubmitOrder(), sink=path).walk(priority=3, resume_from=path)
+        records = list(open_sink(path).records())
+        self.assertEqual([record['id'] for record in records],
+                         list(range(1, 26)))
+
+        # a checkpoint inside a subtree handed to a worker
+        path = os.path.join(output_dir, 'parallel.jsonl')
+        Flow(SubmitOrder(), sink=path).walk(priority=3, budget=Budget(routes=4))
+        Flow(SubmitOrder(), sink=path).walk(priority=3, resume_from=path,
+                                            workers=2)
+        records = list(open_sink(path).records())
+        self.assertEqual([record['id'] for record in records],
+                         list(range(1, 26)))
+        self.assertEqual(
+            [[(node['label'], node['step']) for node in record['nodes']]
+             for record in records],
+            route_labels(serial))
+
+    def test_sharded_walk(self):
+        serial = Flow(SubmitOrder())
+        serial.walk(priority=3)
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        paths = [os.path.join(output_dir, 'shard-{}.jsonl'.format(shard))
+                 for shard in range(3)]
+        counts = []
+        for shard, path in enumerate(paths):
+            flow = Flow(SubmitOrder(), sink=path)
+            flow.walk(priority=3, shard=(shard, 3), split_depth=2)
+            counts.append(flow.route_count)
+        self.assertEqual(sum(counts), 25)
+        merged = Flow(SubmitOrder())
+        merged.load(merge_shards(paths))
+        self.assertEqual(route_labels(merged), route_labels(serial))
+        self.assertEqual([(start, end, str(ids)) for start, end, ids in merged.edges],
+                         [(start, end, str(ids)) for start, end, ids in serial.edges])
+
+        # cases at the split depth only run in their own shard
+        runs = 0
+        for shard in range(3):
+            flow = Flow(SubmitOrder())
+            flow.walk(priority=3, shard=(shard, 3))
+            runs += flow.runs
+        self.assertEqual(runs, serial.runs)
+
+    def test_incremental_walk(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        path = os.path.join(output_dir, 'cache.json')
+        first = Flow(SubmitOrder())
+        first.walk(priority=3, cache=path)
+        unchanged = Flow(SubmitOrder())
+        unchanged.walk(priority=3, cache=path)
+        self.assertEqual(unchanged.runs, 0)
+        self.assertEqual(route_labels(unchanged), route_labels(first))
+
+        run = PackageGift.run
+        self.addCleanup(setattr, PackageGift, 'run', run)
+        PackageGift.run = lambda self, params: run(self, params)
+        changed = Flow(SubmitOrder())
+        changed.walk(priority=3, cache=path)
+        self.assertGreater(changed.runs, 0)
+        self.assertLess(changed.runs, first.runs)
+        self.assertEqual(route_labels(changed), route_labels(first))
+        again = Flow(SubmitOrder())
+        again.walk(priority=3, cache=path)
+        self.assertEqual(again.runs, 0)
+
+        submit = SubmitOrder.run
+        self.addCleanup(setattr, SubmitOrder, 'run', submit)
+
+        def deliver(self, params):
+            return DeliverGoods(order_id=Service.create_order(params))
+        SubmitOrder.run = deliver
+        fresh = Flow(SubmitOrder())
+        fresh.walk(priority=3)
+        redirected = Flow(SubmitOrder())
+        redirected.walk(priority=3, cache=path)
+        self.assertEqual(route_labels(redirected), route_labels(fresh))
+
+    def test_replay(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        path = os.path.join(output_dir, 'routes.jsonl')
+        Flow(SubmitOrder(), sink=path).walk(priority=3)
+        results = Flow(SubmitOrder()).replay(path, workers=2)
+        self.assertEqual([result.route_id for result in results], list(range(1, 26)))
+        self.assertTrue(all(result.passed for result in results))
+
+        run = DeliverGoods.run
+        self.addCleanup(setattr, DeliverGoods, 'run', run)
+
+        def refuse(self, params):
+            raise FlowError('用户拒收')
+        DeliverGoods.run = refuse
+        results = Flow(SubmitOrder()).replay(path)
+        diverged = [result for result in results if not result.passed]
+        self.assertTrue(diverged)
+        for result in diverged:
+            self.assertEqual(result.expected[result.depth], '订单完成')
+            self.assertEqual(result.actual[result.depth], '用户拒收')
+
+    def test_replay_values(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        for name in ['routes.jsonl', 'routes.db']:
+            path = os.path.join(output_dir, name)
+            flow = Flow(Parcel(), sink=path)
+            flow.walk()
+            results = Flow(Parcel()).replay(path)
+            self.assertTrue(all(result.passed for result in results))
+            loaded = Flow(Parcel())
+            loaded.load(open_sink(path).records())
+            self.assertEqual([node.case.values for node in loaded.routes[0]],
+                             [node.case.values for node in flow.routes[0]])
+
+    def test_batch_walk(self):
+        serial = Flow(SubmitOrder())
+        serial.walk(priority=3)
+        batched = Flow(BatchSubmitOrder())
+        batched.walk(priority=3)
+        self.assertEqual(route_labels(batched), route_labels(serial))
+        self.assertEqual(batched.step.batches, [8])
+
+    def test_resources(self):
+        clients = []
+        resources = ResourcePool()
+        resources.register('client', lambda: clients.append([]) or clients[-1])
+        flow = HookedFlow(PooledSubmitOrder(), resources=resources)
+        flow.walk(priority=3)
+        self.assertEqual(flow.hooks, {'walk': 1, 'route': 25, 'end': 25})
+        self.assertEqual(flow.step.clients, [0] * 8)
+        self.assertEqual(clients, [[]])
+
+        # the lambda can't be sent to the workers, nor borrowed there
+        parallel = Flow(SubmitOrder(), resources=resources, events=None)
+        parallel.walk(priority=3, workers=2)
+        self.assertEqual(parallel.route_count, 25)
+        with self.assertRaises(ValueError):
+            pickle.loads(pickle.dumps(resources)).borrow('client')
+
+    def test_timeout(self):
+        flow = Flow(SlowRetry())
+        flow.walk(step_timeout=0.2)
+        self.assertEqual([str(route[-1].step) for route in flow.routes],
+                         ['重试 timed out', '放弃'])
+        self.assertIsInstance(list(flow.routes)[0][-1].step, StepTimeout)
+        flow = Flow(SlowRetry(delay=0.02))
+        flow.walk(route_timeout=0.1)
+        routes = list(flow.routes)
+        self.assertEqual(str(routes[0][-1].step), '重试 timed out')
+        self.assertEqual(str(routes[-1][-1].step), '放弃')
+        self.assertIn(('重试', '重试 timed out'),
+                      [(start, end) for start, end, _ in flow.edges])
+
+        # the second case of 重试 replays 卡住, which hangs from then on
+        HangingRetry.runs = 0
+        flow = Flow(HangingRetry())
+        flow.walk(step_timeout=0.2, max_depth=2)
+        self.assertEqual([str(route[-1].step) for route in flow.routes],
+                         ['重试', '卡住 timed out', '卡住 timed out'])
+        record = {'id': 1, 'nodes': [{'values': {'retry': True}, 'step': '重试'}]}
+        result, = Flow(HangingRetry()).replay([record], step_timeout=0.2)
+        self.assertEqual(result.actual, ['卡住 timed out'])
+
+        AsyncHangingRetry.runs = 0
+        flow = AsyncFlow(AsyncHangingRetry())
+        asyncio.run(flow.walk(step_timeout=0.2))
+        self.assertEqual(route_labels(flow),
+                         [[('重试', '房间'), ('离开', '完成')],
+                          [('重试', '房间'), ('留下', '卡住 timed out')],
+                          [('放弃', '卡住 timed out')]])
+
+    def test_export(self):
+        flow = Flow(SubmitOrder())
+        flow.walk(priority=3)
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        flow.export(os.path.join(output_dir, 'routes.json'))
+        with open(os.path.join(output_dir, 'routes.json'), encoding='utf-8') as f:
+            edges = json.load(f)['edges']
+        self.assertEqual(len(edges), len(flow.edges))
+        self.assertEqual(sum(last - first + 1
+                             for edge in edges if edge['source'] == '提交订单'
+                             for first, last in edge['routes']), 25)
+        flow.export(os.path.join(output_dir, 'routes.graphml'))
+        ElementTree.parse(os.path.join(output_dir, 'routes.graphml'))
+        flow.draw('dot', os.path.join(output_dir, 'routes.png'), split=True)
+        self.assertEqual(
+            len([name for name in os.listdir(output_dir) if name.endswith('.gv')]),
+            len(flow.edges.by_start()))
+
+    def test_stats(self):
+        stats = WalkStats()
+        flow = Flow(SubmitOrder(), instrument=stats)
+        flow.walk(priority=3)
+        self.assertEqual(sum(step.calls for step in stats.steps.values()),
+                         flow.runs)
+        self.assertEqual(stats.steps['SubmitOrder'].calls, 8)
+        self.assertEqual(stats.routes, 25)
+        # cases over the priority left to their route are not generated
+        self.assertEqual(stats.cases_generated, 49)
+        self.assertEqual(stats.cases_pruned, 7)
+        self.assertEqual(json.loads(stats.to_json())['routes'], 25)
+        self.assertIn('aria_step_seconds_count{step="SubmitOrder"} 8',
+                      stats.to_prometheus())
+
+        parallel_stats = WalkStats()
+        parallel = Flow(SubmitOrder(), instrument=parallel_stats)
+        parallel.walk(priority=3, workers=2)
+        self.assertEqual(sorted(parallel_stats.steps), sorted(stats.steps))
+        self.assertEqual(sum(step.calls for step in parallel_stats.steps.values()),
+                         parallel.runs)
+        self.assertGreaterEqual(parallel.runs, flow.runs)
+        self.assertEqual(parallel_stats.routes, 25)
+
+    def test_default_log(self):
+        script = ('import logging, aria.walker\n'
+                  'logger = logging.getLogger("aria.walker")\n'
+                  'print(len(logger.handlers), logger.propagate)')
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=ROOT)
+        self.assertEqual(output.split(), [b'0', b'True'])
+        with self.assertLogs(level='INFO') as logs:
+            Flow(Door()).walk()
+        self.assertIn('INFO:aria.walker:完成', logs.output)
+    def test_events(self):
+        buffer = RingBufferSink(size=10)
+        flow = Flow(SubmitOrder(), events=QueueSink(buffer))
+        flow.walk(priority=3)
+        flow.events.close()
+        self.assertEqual(len(buffer.events), 10)
+        self.assertEqual(buffer.events[-1].kind, 'walk_end')
+        ends = [event for event in buffer.events if event.kind == 'route_end']
+        self.assertEqual(ends[-1].data['route'], 25)
+
+        quiet = Flow(SubmitOrder(), events=NullSink())
+        quiet.walk(priority=3)
+        self.assertEqual(len(quiet.routes), 25)
+        with self.assertNoLogs('aria.walker'):
+            Flow(SubmitOrder(), events=None).walk(priority=3)
+
+        buffer = RingBufferSink(size=100)
+        concurrent = AsyncFlow(AsyncSubmitOrder(), events=buffer)
+        asyncio.run(concurrent.walk(priority=3))
+        self.assertEqual(buffer.events[-1].kind, 'walk_end')
+
+    def test_async_walk(self):
+        serial = Flow(SubmitOrder())
+        serial.walk(priority=3)
+        concurrent = AsyncFlow(AsyncSubmitOrder(), concurrency=4)
+        asyncio.run(concurrent.walk(priority=3))
+        self.assertEqual(route_labels(concurrent), route_labels(serial))
+
+        # routes are written as they end, in the order of a serial walk
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        path = os.path.join(output_dir, 'routes.jsonl')
+        buffer = RingBufferSink(size=1000)
+        streamed = AsyncFlow(AsyncSubmitOrder(), sink=path, keep_routes=False,
+                             events=buffer)
+        asyncio.run(streamed.walk(priority=3))
+        self.assertEqual(len(streamed.routes), 0)
+        records = list(open_sink(path).records())
+        self.assertEqual([record['id'] for record in records], list(range(1, 26)))
+        self.assertEqual(
+            [[(node['label'], node['step']) for node in record['nodes']]
+             for record in records],
+            route_labels(serial))
+        kinds = [event.kind for event in buffer.events]
+        self.assertLess(kinds.index('route_end'),
+                        len(kinds) - 1 - kinds[::-1].index('step_enter'))
+
+
+class Retry(Step):
+    """无限重试
+    """
+    name = '重试'
+    form = Form({
+        'retry': EnumField({'重试': True, '放弃': False}),
+    })
+
+    def run(self, params):
+        if params['retry']:
+            return Retry()
+        raise FlowFinished('放弃')
+
+
+class SlowRetry(Retry):
+    """慢速重试
+    """
+    delay = 1
+
+    def run(self, params):
+        if params['retry']:
+            time.sleep(self.delay)
+            return SlowRetry(delay=self.delay)
+        raise FlowFinished('放弃')
+
+
+class HangingRetry(Retry):
+    """第一次之后卡住
+    """
+    name = '卡住'
+    runs = 0
+
+    def run(self, params):
+        HangingRetry.runs += 1
+        if HangingRetry.runs > 1:
+            time.sleep(1)
+        return Retry()
+
+
+class Door(Step):
+    """门
+    """
+    name = '门'
+    form = Form({
+        'enter': EnumField({'进门': True, '敲门': False}),
+    })
+
+    def run(self, params):
+        return Room()
+
+
+class Room(Step):
+    """房间
+    """
+    name = '房间'
+    form = Form({
+        'leave': EnumField({'离开': True, '留下': False}),
+    })
+
+    def run(self, params):
+        raise FlowFinished('完成')
+
+
+class Parcel(Step):
+    """包裹
+    """
+    name = '包裹'
+    form = Form({
+        'size': EnumField({'小件': (1, 2), '大件': (3, 4)}),
+        'price': EnumField({'便宜': Decimal('0.10'), '贵': Decimal('9.90')}),
+    })
+
+    def run(self, params):
+        if not (isinstance(params['size'], tuple)
+                and isinstance(params['price'], Decimal)):
+            raise FlowError('参数不对')
+        raise FlowFinished('签收')
+
+
+class Gate(Door):
+    """大门
+    """
+    name = '大门'
+
+    def run(self, params):
+        return Hall()
+
+
+class Hall(Door):
+    """大厅
+    """
+    name = '大厅'
+
+    def run(self, params):
+        return Door()
+
+    def snapshot(self):
+        return {}
+
+    def restore(self, state):
+        pass
+
+
+class PausingFlow(Flow):
+    """Pause after the fifth route
+    """
+    def route_end(self, route):
+        super(PausingFlow, self).route_end(route)
+        if len(self.routes) == 5:
+            self.pause()
+
+
+class PooledSubmitOrder(SubmitOrder):
+    """借用客户端的提交订单
+    """
+    def __init__(self, **kwargs):
+        super(PooledSubmitOrder, self).__init__(**kwargs)
+        self.clients = []
+
+    def setup(self, resources):
+        self._client = resources.borrow('client')
+        self.clients.append(len(self._client))
+        self._client.append(1)
+
+    def teardown(self, resources):
+        self._client.pop()
+        resources.give_back('client', self._client)
+
+
+class HookedFlow(Flow):
+    def __init__(self, *args, **kwargs):
+        super(HookedFlow, self).__init__(*args, **kwargs)
+        self.hooks = {'walk': 0, 'route': 0, 'end': 0}
+
+    def setup_walk(self):
+        self.hooks['walk'] += 1
+
+    def setup_route(self):
+        self.hooks['route'] += 1
+
+    def teardown_route(self):
+        self.hooks['end'] += 1
+
+
+class BatchSubmitOrder(SubmitOrder):
+    """批量提交订单
+    """
+    def __init__(self, **kwargs):
+        super(BatchSubmitOrder, self).__init__(**kwargs)
+        self.batches = []
+
+    def run_batch(self, params_list):
+        self.batches.append(len(params_list))
+        outcomes = []
+        for params in params_list:
+            try:
+                outcomes.append(self.run(params))
+            except FlowError as e:
+                outcomes.append(e)
+        return outcomes
+
+
+class AsyncSubmitOrder(SubmitOrder):
+    """异步提交订单
+    """
+    async def run(self, params):
+        await asyncio.sleep(0)
+        return SubmitOrder.run(self, params)
+
+
+class AsyncHangingRetry(Retry):
+    """第一次之后卡住的异步步骤
+    """
+    name = '卡住'
+    runs = 0
+
+    async def run(self, params):
+        AsyncHangingRetry.runs += 1
+        if AsyncHangingRetry.runs > 1:
+            await asyncio.sleep(1)
+        return Room()
+
+
+def route_labels(flow):
+    return [[(node.case.label, str(node.step)) for node in route]
+            for route in flow.routes]
+
+
 def main():
     step = SubmitOrder()
     flow = Flow(step)
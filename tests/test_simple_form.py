@@ -1,9 +1,12 @@
 # coding: utf-8
 """Tests for simple forms
 """
+import time
 import unittest
+from itertools import combinations
 
 from aria import Form, EnumField, IntegerField, TextField
+from aria import Constraint, Allowed, Forbidden
 
 
 class SimpleFormTest(unittest.TestCase):
@@ -18,6 +21,213 @@ class SimpleFormTest(unittest.TestCase):
         for case in form.iter_cases(priority=1):
             print(case)
 
+    def test_count_cases(self):
+        form = Form({
+            'ef': EnumField([('v1', 1), ('v2', 2)], [('v5', 5), ('v6', 6)]),
+            'nf': IntegerField(4, 9),
+            'tf': TextField(3, 8, 'abcdef'),
+        })
+        for priority in range(4):
+            self.assertEqual(form.count_cases(priority),
+                             len(form.list_cases(priority)))
+
+    def test_case_at(self):
+        form = Form({
+            'ef': EnumField([('v1', 1), ('v2', 2)], [('v5', 5), ('v6', 6)]),
+            'nf': IntegerField(4, 9),
+            'tf': TextField(3, 8, 'abcdef'),
+        })
+        for priority in range(4):
+            for index, case in enumerate(form.iter_cases(priority)):
+                self.assertEqual(form.case_at(index, priority).label, case.label)
+        self.assertRaises(IndexError, form.case_at, len(form))
+
+    def test_sample(self):
+        form = Form({
+            'ef': EnumField([('v1', 1), ('v2', 2)], [('v5', 5), ('v6', 6)]),
+            'nf': IntegerField(4, 9),
+            'tf': TextField(3, 8, 'abcdef'),
+        })
+        cases = form.sample(8, priority=3, seed=1, stratified=True)
+        self.assertEqual(len(cases), 8)
+        self.assertEqual({case.priority for case in cases}, {0, 1, 2, 3})
+        again = form.sample(8, priority=3, seed=1, stratified=True)
+        self.assertEqual([case.label for case in cases],
+                         [case.label for case in again])
+
+    def test_case_batch(self):
+        form = Form({
+            'ef': EnumField([('v1', 1), ('v2', 2)], [('v5', 5), ('v6', 6)]),
+            'nf': IntegerField(4, 9),
+            'tf': TextField(3, 8, 'abcdef'),
+        })
+        batches = list(form.iter_batches(priority=3, size=10))
+        self.assertEqual(sum(map(len, batches)), form.count_cases(3))
+        for batch in batches:
+            self.assertEqual(list(batch.labels()), [case.label for case in batch])
+            for case, priority in zip(batch, batch.priorities):
+                self.assertEqual(case.priority, priority)
+
+    def test_pairwise_form(self):
+        fields = {
+            'ef': EnumField([('v1', 1), ('v2', 2)], [('v5', 5), ('v6', 6)]),
+            'gf': EnumField([('g1', 1), ('g2', 2), ('g3', 3)]),
+            'nf': IntegerField(4, 9),
+            'tf': TextField(3, 8, 'abcdef'),
+        }
+        full = Form(fields).list_cases(priority=3)
+        pairwise = Form(fields, strength=2).list_cases(priority=3)
+        self.assertLess(len(pairwise), len(full))
+        labels = [case.label.split() for case in full]
+        for i, j in combinations(range(len(fields)), 2):
+            expected = {(label[i], label[j]) for label in labels}
+            covered = {(case.label.split()[i], case.label.split()[j])
+                       for case in pairwise}
+            self.assertEqual(covered, expected)
+
+    def test_seeded_form(self):
+        def make_form(seed):
+            return Form({
+                'nf': IntegerField(4, 900),
+                'tf': TextField(3, 8, 'abcdef'),
+            }, seed=seed)
+        values = [case.values for case in make_form(7).iter_cases(priority=2)]
+        self.assertEqual(
+            [case.values for case in make_form(7).iter_cases(priority=2)], values)
+        self.assertNotEqual(
+            [case.values for case in make_form(8).iter_cases(priority=2)], values)
+        form = make_form(7)
+        self.assertEqual([form.case_at(idx, priority=2).values
+                          for idx in range(len(values))], values)
+
+        texts = make_form(7).fields['tf'].generate(1000)
+        self.assertEqual(make_form(7).fields['tf'].generate(1000), texts)
+        field = make_form(7).fields['tf']
+        self.assertEqual(field.generate(1000), texts)
+        self.assertNotEqual(field.generate(1000), texts)
+        self.assertTrue(all(3 <= len(text) <= 8 and set(text) <= set('abcdef')
+                            for text in texts))
+        numbers = make_form(7).fields['nf'].generate(1000)
+        self.assertTrue(all(4 < number < 900 for number in numbers))
+
+    def test_regenerate(self):
+        def plain_values(form):
+            return {case.values['tf'] for case in form.iter_cases(priority=1)
+                    if case.label.startswith('plain')}
+        fixed = Form({'tf': TextField(20)}, regenerate='run')
+        values = plain_values(fixed)
+        self.assertEqual(plain_values(fixed), values)
+        fixed.refresh()
+        self.assertNotEqual(plain_values(fixed), values)
+
+        every_visit = Form({'tf': TextField(20)})
+        self.assertEqual(len(plain_values(every_visit) | plain_values(every_visit)), 2)
+
+        seeded = [Form({'tf': TextField(20)}, seed=3) for _ in range(2)]
+        visits = [[plain_values(form) for _ in range(2)] for form in seeded]
+        self.assertNotEqual(visits[0][0], visits[0][1])
+        self.assertEqual(visits[0], visits[1])
+
+        every_2 = Form({'tf': TextField(20)}, regenerate=2)
+        values = [plain_values(every_2) for _ in range(4)]
+        self.assertEqual(values[0], values[1])
+        self.assertNotEqual(values[1], values[2])
+        self.assertEqual(values[2], values[3])
+
+    def test_constraints(self):
+        fields = {
+            'package': EnumField({'gift': 'gift', 'standard': 'standard',
+                                  'none': 'none'}),
+            'payment': EnumField({'online': 'online', 'cod': 'cod',
+                                  'card': 'card'}),
+            'nf': EnumField([('n1', 1), ('n2', 2), ('n3', 3)]),
+            'mf': EnumField([('m1', 1), ('m2', 2)]),
+        }
+        constraints = [
+            Forbidden(['package', 'payment'], [('gift', 'cod')]),
+            Constraint(['nf', 'mf'], lambda n, m: n + m != 4),
+        ]
+
+        def valid(case):
+            values = case.values
+            return ((values['package'], values['payment']) != ('gift', 'cod')
+                    and values['nf'] + values['mf'] != 4)
+        form = Form(fields, constraints=constraints)
+        for priority in range(4):
+            cases = form.list_cases(priority)
+            expected = [case.label for case in Form(fields).iter_cases(priority)
+                        if valid(case)]
+            self.assertEqual([case.label for case in cases], expected)
+            self.assertEqual(form.count_cases(priority), len(cases))
+            self.assertEqual([form.case_at(idx, priority).label
+                              for idx in range(len(cases))], expected)
+
+        pairwise = Form(fields, strength=2, constraints=constraints).list_cases(3)
+        self.assertTrue(all(valid(case) for case in pairwise))
+        labels = [case.label.split() for case in form.list_cases(3)]
+        for i, j in combinations(range(len(fields)), 2):
+            expected = {(label[i], label[j]) for label in labels}
+            covered = {(case.label.split()[i], case.label.split()[j])
+                       for case in pairwise}
+            self.assertEqual(covered, expected)
+
+        # a single value field: rows built around it can't all be completed
+        with self.assertWarns(UserWarning):
+            single = EnumField([('b0', 0)])
+        singleton = {
+            'f0': EnumField([('a0', 0), ('a1', 1), ('a2', 2), ('a3', 3)]),
+            'f1': single,
+            'f2': EnumField([('c0', 0), ('c1', 1), ('c2', 2)]),
+            'f3': EnumField([('d0', 0), ('d1', 1), ('d2', 2), ('d3', 3)]),
+        }
+        constrained = [Forbidden(['f2', 'f1'], [(0, 0)])]
+        labels = [case.label.split() for case in
+                  Form(singleton, constraints=constrained).list_cases(3)]
+        pairwise = [case.label.split() for case in
+                    Form(singleton, strength=2,
+                         constraints=constrained).list_cases(3)]
+        for i, j in combinations(range(len(singleton)), 2):
+            self.assertEqual({(label[i], label[j]) for label in pairwise},
+                             {(label[i], label[j]) for label in labels})
+
+        # constraints sharing a field: dead ends are found ahead, not after
+        # every other field was tried
+        many = {'f{}'.format(i): EnumField([('v{}'.format(v), v) for v in range(4)])
+                for i in range(12)}
+        crossed = Form(many, strength=2, constraints=[
+            Constraint(['f0', 'f11'], lambda a, b: a != 0 or b == 0),
+            Forbidden(['f1', 'f11'], [(0, 0)])])
+        started = time.time()
+        rows = crossed.list_cases(3)
+        self.assertLess(time.time() - started, 1)
+        self.assertTrue(all(case.values['f1'] != 0 or case.values['f11'] != 0
+                            for case in rows))
+
+        allowed = Form(fields, constraints=[
+            Allowed(['payment', 'mf'], [('online', 1), ('card', 2)])])
+        self.assertEqual(allowed.count_cases(3), 3 * 2 * 3)
+        with self.assertRaises(ValueError):
+            Form(fields, constraints=[Allowed(['color'], [('red',)])])
+
+    def test_max_priority(self):
+        form = Form({
+            'ef': EnumField([('v1', 1), ('v2', 2)], [('v5', 5), ('v6', 6)]),
+            'nf': IntegerField(4, 9),
+            'tf': TextField(3, 8, 'abcdef'),
+        }, regenerate='run')
+        for priority in range(4):
+            cases = form.list_cases(priority)
+            for max_priority in range(-1, 4):
+                pruned = []
+                self.assertEqual(
+                    [(case.index, case.label) for case in
+                     form.iter_cases(priority, max_priority=max_priority,
+                                     pruned=pruned.append)],
+                    [(case.index, case.label) for case in cases
+                     if case.priority <= max_priority])
+                self.assertEqual(sum(pruned), len(
+                    [case for case in cases if case.priority > max_priority]))
+
 
 if __name__ == '__main__':
     unittest.main()